@@ -0,0 +1,423 @@
+import argparse
+import importlib.util
+import json
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Benchmark di tricount-to-firefly contro server locali che simulano Tricount e Firefly III
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tricount-to-firefly.py")
+DEFAULT_ENTRIES = 1000         # Numero di movimenti nel registro Tricount simulato
+DEFAULT_EXISTING = 0.5         # Frazione di movimenti già presenti in Firefly III
+DEFAULT_LATENCY = 0.005        # Latenza (secondi) aggiunta a ogni richiesta
+DEFAULT_CATEGORIES = 40        # Numero di categorie distinte nel registro
+FIREFLY_PAGE_SIZE = 50         # Elementi per pagina, come l'API di Firefly III
+CATEGORY_NAMES = ["🍕 Food", "🚗 Transport", "🏠 Home", "🎉 Fun", "✈️ Travel", "🛒 Groceries"]
+
+def load_script():
+    """Importa tricount-to-firefly.py come modulo (il nome del file contiene trattini)"""
+    spec = importlib.util.spec_from_file_location("tricount_to_firefly", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def entry_date(i):
+    """Date distribuite sull'ultimo anno, dentro il range di conservazione degli hash"""
+    return (datetime.now() - timedelta(days=i % 365)).strftime('%Y-%m-%d')
+
+def make_registry(entries, categories):
+    """Genera una risposta del registro Tricount con il numero di movimenti richiesto"""
+    members = ["Alice", "Bob", "Carla", "Dario"]
+    registry_entries = []
+    for i in range(entries):
+        payer = members[i % len(members)]
+        amount = 1 + (i % 997) / 10
+        category = CATEGORY_NAMES[i % len(CATEGORY_NAMES)]
+        registry_entries.append({
+            "RegistryEntry": {
+                "uuid": str(uuid.UUID(int=i + 1)),
+                "type_transaction": "NORMAL",
+                "membership_owned": {"RegistryMembershipNonUser": {"alias": {"display_name": payer}}},
+                "amount": {"value": f"{-amount:.2f}", "currency": "EUR"},
+                "description": f"Spesa {i}",
+                "date": f"{entry_date(i)} 12:00:00.000000",
+                "allocations": [
+                    {
+                        "membership": {"RegistryMembershipNonUser": {"alias": {"display_name": member}}},
+                        "amount": {"value": f"{-amount / len(members):.2f}"}
+                    }
+                    for member in members
+                ],
+                "category": category,
+                "category_custom": f"Custom {i % categories}" if i % 2 else None
+            }
+        })
+    return {"Response": [{"Registry": {"title": "Benchmark", "all_registry_entry": registry_entries}}]}
+
+class MockState:
+    """Dati condivisi dai server simulati e contatori delle richieste"""
+    def __init__(self, entries, existing, categories, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.registry_body = json.dumps(make_registry(entries, categories)).encode()
+        self.transactions = []  # Gruppi Firefly: l'ID del gruppo è la posizione + 1 (None se eliminato)
+        self.external_ids = set()
+        self.journal_count = 0
+        self.categories = []
+        for i in range(int(entries * existing)):
+            self.add_transaction([{
+                "external_id": str(uuid.UUID(int=i + 1)),
+                "date": entry_date(i),
+                "tags": ["imported", "tricount"]
+            }])
+
+    def make_split(self, split):
+        """Split salvato come in Firefly III: data con orario e ID del journal"""
+        if not split.get("transaction_journal_id"):
+            self.journal_count += 1
+            split = dict(split, transaction_journal_id=str(self.journal_count))
+        return dict(split, date=f"{split['date'][:10]}T00:00:00+00:00")
+
+    def add_transaction(self, splits):
+        """Crea un gruppo con tutti gli split ricevuti, come una POST /transactions di Firefly III"""
+        transaction = {
+            "id": str(len(self.transactions) + 1),
+            "attributes": {"transactions": [self.make_split(split) for split in splits]}
+        }
+        self.transactions.append(transaction)
+        self.external_ids.update(split["external_id"] for split in splits)
+        return transaction
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] += 1
+
+def in_scan(transaction, params, tag=None):
+    """Filtri della scansione Firefly: intervallo start/end sulle date degli split e tag"""
+    start = params.get("start", [""])[0]
+    end = params.get("end", [""])[0]
+    for split in transaction["attributes"]["transactions"]:
+        date = split["date"][:10]
+        if (not start or date >= start) and (not end or date <= end) and (not tag or tag in split.get("tags", [])):
+            return True
+    return False
+
+def paginate(items, params):
+    page = int(params.get("page", ["1"])[0])
+    total_pages = max(1, -(-len(items) // FIREFLY_PAGE_SIZE))
+    start = (page - 1) * FIREFLY_PAGE_SIZE
+    return {
+        "data": items[start:start + FIREFLY_PAGE_SIZE],
+        "meta": {"pagination": {"current_page": page, "total_pages": total_pages, "total": len(items)}}
+    }
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Implementa il sottoinsieme delle API Tricount e Firefly III usato dallo script"""
+    protocol_version = "HTTP/1.1"  # Keep-alive, per misurare il riutilizzo delle connessioni
+    disable_nagle_algorithm = True  # Evita i ritardi di 40 ms tra header e corpo della risposta
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload=None, body=None):
+        body = body if body is not None else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_GET(self):
+        state = self.state
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        time.sleep(state.latency)
+        if re.fullmatch(r"/v1/user/[^/]+/registry", url.path):
+            state.count("tricount registry")
+            self.send_json(200, body=state.registry_body)
+        elif url.path == "/api/v1/about":
+            state.count("firefly about")
+            self.send_json(200, {"data": {"version": "benchmark"}})
+        elif url.path == "/api/v1/accounts":
+            state.count("firefly accounts")
+            self.send_json(200, {"data": [{"id": "1", "attributes": {"name": "Benchmark"}}]})
+        elif url.path == "/api/v1/categories":
+            state.count("firefly categories")
+            with state.lock:
+                categories = list(state.categories)
+            self.send_json(200, paginate(categories, params))
+        elif re.fullmatch(r"/api/v1/transactions/\d+", url.path):
+            state.count("firefly transaction get")
+            index = int(url.path.rsplit("/", 1)[1]) - 1
+            with state.lock:
+                transaction = state.transactions[index] if index < len(state.transactions) else None
+            if transaction is None:
+                self.send_json(404, {"message": "Not found"})
+            else:
+                self.send_json(200, {"data": transaction})
+        elif url.path == "/api/v1/transactions" or re.fullmatch(r"/api/v1/tags/[^/]+/transactions", url.path):
+            state.count("firefly transactions scan")
+            tag = url.path.split("/")[4] if url.path.startswith("/api/v1/tags/") else None
+            with state.lock:
+                transactions = [
+                    transaction for transaction in state.transactions
+                    if transaction is not None and in_scan(transaction, params, tag)
+                ]
+            self.send_json(200, paginate(transactions, params))
+        else:
+            self.send_json(404, {"message": "Not found"})
+
+    def do_POST(self):
+        state = self.state
+        url = urlparse(self.path)
+        payload = self.read_json()
+        time.sleep(state.latency)
+        if url.path == "/v1/session-registry-installation":
+            state.count("tricount auth")
+            self.send_json(200, {"Response": [{"Token": {"token": "benchmark-token"}}, {"UserPerson": {"id": 1}}]})
+        elif url.path == "/api/v1/categories":
+            state.count("firefly categories create")
+            with state.lock:
+                category = {"id": str(len(state.categories) + 1), "attributes": {"name": payload["name"]}}
+                state.categories.append(category)
+            self.send_json(200, {"data": category})
+        elif url.path == "/api/v1/transactions":
+            state.count("firefly transactions create")
+            splits = payload.get("transactions", [])
+            with state.lock:
+                if any(split.get("external_id") in state.external_ids for split in splits):
+                    self.send_json(422, {"message": "Duplicate of transaction #1."})
+                    return
+                transaction = state.add_transaction(splits)
+            self.send_json(200, {"data": transaction})
+        else:
+            self.send_json(404, {"message": "Not found"})
+
+    def do_PUT(self):
+        state = self.state
+        url = urlparse(self.path)
+        payload = self.read_json()
+        time.sleep(state.latency)
+        match = re.fullmatch(r"/api/v1/transactions/(\d+)", url.path)
+        if not match:
+            self.send_json(404, {"message": "Not found"})
+            return
+        state.count("firefly transactions update")
+        index = int(match.group(1)) - 1
+        with state.lock:
+            if index >= len(state.transactions) or state.transactions[index] is None:
+                self.send_json(404, {"message": "Not found"})
+                return
+            # Come Firefly III: gli split inviati sostituiscono quelli del gruppo, gli altri vengono eliminati
+            existing = {split["transaction_journal_id"]: split for split in state.transactions[index]["attributes"]["transactions"]}
+            splits = [
+                state.make_split(dict(existing.get(split.get("transaction_journal_id"), {}), **split))
+                for split in payload["transactions"]
+            ]
+            for split in existing.values():
+                state.external_ids.discard(split.get("external_id"))
+            state.external_ids.update(split["external_id"] for split in splits if split.get("external_id"))
+            state.transactions[index]["attributes"]["transactions"] = splits
+            transaction = state.transactions[index]
+        self.send_json(200, {"data": transaction})
+
+    def do_DELETE(self):
+        state = self.state
+        url = urlparse(self.path)
+        time.sleep(state.latency)
+        journal_match = re.fullmatch(r"/api/v1/transaction-journals/(\d+)", url.path)
+        if journal_match:
+            # Elimina un solo split; il gruppo viene eliminato quando resta vuoto
+            state.count("firefly journal delete")
+            with state.lock:
+                for index, transaction in enumerate(state.transactions):
+                    splits = transaction["attributes"]["transactions"] if transaction else []
+                    split = next((split for split in splits if split["transaction_journal_id"] == journal_match.group(1)), None)
+                    if split:
+                        splits.remove(split)
+                        state.external_ids.discard(split.get("external_id"))
+                        if not splits:
+                            state.transactions[index] = None
+                        break
+                else:
+                    self.send_json(404, {"message": "Not found"})
+                    return
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        match = re.fullmatch(r"/api/v1/transactions/(\d+)", url.path)
+        if not match:
+            self.send_json(404, {"message": "Not found"})
+            return
+        state.count("firefly transactions delete")
+        index = int(match.group(1)) - 1
+        with state.lock:
+            if index >= len(state.transactions) or state.transactions[index] is None:
+                self.send_json(404, {"message": "Not found"})
+                return
+            for split in state.transactions[index]["attributes"]["transactions"]:
+                state.external_ids.discard(split.get("external_id"))
+            state.transactions[index] = None
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+def start_server(state):
+    handler = type("BoundMockHandler", (MockHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss è in KB su Linux e in byte su macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+class PhaseRecorder:
+    """Misura tempo, richieste, RSS di picco e throughput di ogni fase"""
+    def __init__(self, state):
+        self.state = state
+        self.phases = []
+        self.nested = {}  # Fase annidata -> [secondi, richieste, righe]
+
+    def add(self, name, elapsed, requests, rows):
+        self.phases.append({
+            "phase": name,
+            "seconds": round(elapsed, 4),
+            "requests": requests,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "rows": rows,
+            "rows_per_second": round(rows / elapsed, 1) if rows and elapsed > 0 else None
+        })
+
+    def run(self, name, func, rows=None):
+        self.nested = {}
+        requests_before = sum(self.state.requests.values())
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        requests = sum(self.state.requests.values()) - requests_before
+        rows = rows(result) if callable(rows) else rows
+        # Le fasi annidate vengono riportate a parte e tolte dalla fase che le contiene
+        self.add(name, elapsed - sum(seconds for seconds, _, _ in self.nested.values()),
+                 requests - sum(count for _, count, _ in self.nested.values()), rows)
+        for nested_name, (seconds, count, nested_rows) in self.nested.items():
+            self.add(nested_name, seconds, count, nested_rows)
+        return result
+
+    def wrap(self, name, func, rows=None):
+        """Avvolge una funzione chiamata all'interno di una fase per misurarla come fase a sé"""
+        def wrapper(*args, **kwargs):
+            requests_before = sum(self.state.requests.values())
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            stats = self.nested.setdefault(name, [0.0, 0, None])
+            stats[0] += time.perf_counter() - start
+            stats[1] += sum(self.state.requests.values()) - requests_before
+            stats[2] = rows() if callable(rows) else rows
+            return result
+        return wrapper
+
+    def print_report(self):
+        print(f"\n{'Fase':<22}{'Secondi':>10}{'Richieste':>11}{'RSS MB':>9}{'Righe':>9}{'Righe/s':>11}")
+        for phase in self.phases:
+            rows_per_second = phase["rows_per_second"] if phase["rows_per_second"] is not None else "-"
+            rows = phase["rows"] if phase["rows"] is not None else "-"
+            print(f"{phase['phase']:<22}{phase['seconds']:>10}{phase['requests']:>11}{phase['peak_rss_mb']:>9}{rows:>9}{rows_per_second:>11}")
+
+def run_benchmark(entries=DEFAULT_ENTRIES, existing=DEFAULT_EXISTING, latency=DEFAULT_LATENCY, categories=DEFAULT_CATEGORIES, workers=1, hash_backend="json", stream=False, batch_size=1):
+    script = load_script()
+    state = MockState(entries, existing, categories, latency)
+    server, base_url = start_server(state)
+    recorder = PhaseRecorder(state)
+    workdir = tempfile.mkdtemp(prefix="tricount-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)  # hashes.json, sync_state.json e dump finiscono nella cartella temporanea
+    try:
+        api = recorder.run("keygen", lambda: script.TricountAPI(credentials_file=None, base_url=base_url))
+        recorder.run("authenticate", api.authenticate)
+        importer = None
+
+        def timed_save(importer):
+            # save_hashes viene chiamato da import_transactions: misurato come fase "hash save"
+            importer.save_hashes = recorder.wrap("hash save", importer.save_hashes, rows=lambda: len(importer.duplicate_hashes))
+            return importer
+
+        if stream:
+            importer = timed_save(recorder.run("duplicate scan", lambda: script.FireflyIIIImporter(
+                base_url, "benchmark", workers=workers, hash_store=script.create_hash_store(hash_backend), batch_size=batch_size)))
+            recorder.run("stream import", lambda: script.stream_tricount(
+                api, importer, "benchmark", None, "none"), rows=entries)
+        else:
+            data = recorder.run("fetch", lambda: api.fetch_tricount_data("benchmark"))
+            transactions = recorder.run("parse", lambda: script.TricountHandler.parse_tricount_data(data), rows=len)
+            importer = timed_save(recorder.run("duplicate scan", lambda: script.FireflyIIIImporter(
+                base_url, "benchmark", workers=workers, hash_store=script.create_hash_store(hash_backend), batch_size=batch_size)))
+            recorder.run("import", lambda: importer.import_transactions(transactions), rows=entries)
+        recorder.run("hash prune", importer.clean_duplicate_hashes, rows=len(importer.duplicate_hashes))
+        importer.hash_store.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        server.shutdown()
+    return {
+        "config": {
+            "entries": entries, "existing": existing, "latency": latency, "categories": categories,
+            "workers": workers, "hash_backend": hash_backend, "stream": stream, "batch_size": batch_size
+        },
+        "phases": recorder.phases,
+        "requests": dict(state.requests),
+        "total_seconds": round(sum(phase["seconds"] for phase in recorder.phases), 4)
+    }, recorder
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark di tricount-to-firefly con server Tricount/Firefly III simulati')
+    parser.add_argument('--entries', type=int, default=DEFAULT_ENTRIES, help='Numero di movimenti nel registro simulato (fino a 100000)')
+    parser.add_argument('--existing', type=float, default=DEFAULT_EXISTING, help='Frazione di movimenti già presenti in Firefly III')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY, help='Latenza in secondi di ogni richiesta simulata')
+    parser.add_argument('--categories', type=int, default=DEFAULT_CATEGORIES, help='Numero di categorie distinte')
+    parser.add_argument('--workers', type=int, default=1, help='Richieste parallele verso Firefly III')
+    parser.add_argument('--batch-size', type=int, default=1, help='Transazioni per richiesta a Firefly III')
+    parser.add_argument('--hash-backend', default="json", help='Backend per gli UUID importati')
+    parser.add_argument('--stream', action='store_true', help='Usa la modalità streaming')
+    parser.add_argument('--output', help='File JSON in cui salvare i risultati')
+    args = parser.parse_args()
+
+    report, recorder = run_benchmark(
+        entries=args.entries,
+        existing=args.existing,
+        latency=args.latency,
+        categories=args.categories,
+        workers=args.workers,
+        hash_backend=args.hash_backend,
+        stream=args.stream,
+        batch_size=args.batch_size
+    )
+    recorder.print_report()
+    print(f"Totale: {report['total_seconds']} s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Risultati salvati in {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,36 @@ import os
 import re
 import hashlib
 import argparse
+import csv
+import glob
+import gzip
+import threading
+import queue
+import sqlite3
+import time
+import random
+import signal
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from urllib.parse import urlparse
 import rsa
-import pandas as pd
+from dataclasses import dataclass
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 
+try:
+    import fcntl  # Non disponibile su Windows: il lock usa un file esclusivo
+except ImportError:
+    fcntl = None
+
+try:
+    import ijson  # Opzionale: necessario solo per --stream
+except ImportError:
+    ijson = None
+
 # Configurazione con variabili
 DEFAULT_TRICOUNT_KEY = "XXXXXXXXXX"  # Chiave Tricount predefinita
 DEFAULT_FIREFLY_HOST = "http://192.168.1.100"    # Host Firefly III predefinita
@@ -17,43 +42,408 @@ DEFAULT_FIREFLY_TOKEN = "abcdef123456"          # Token Firefly III predefinito
 DEFAULT_ACCOUNT_ID = None                     # Lascia None per trovare il primo account disponibile
 DEFAULT_DAYS_RANGE = 730                      # Numero di giorni per il range temporale di caricamento delle transazioni esistenti
 HASH_FILE = "hashes.json"	              # File per salvare gli hash
+TRICOUNT_BASE_URL = "https://api.tricount.bunq.com"  # Endpoint dell'API Tricount
+TRICOUNT_CREDENTIALS_FILE = "tricount_credentials.json"  # Cache di installazione, chiavi e token Tricount
+TRICOUNT_TOKEN_MAX_AGE_DAYS = 30              # Dopo quanti giorni rinnovare comunque il token Tricount
+DEFAULT_EXPORT_FORMAT = "xlsx"                # Formato dell'export delle transazioni: xlsx, csv, jsonl o parquet
+EXPORT_QUEUE_SIZE = 1000                      # Transazioni in attesa del thread di export in streaming
+RAW_DUMP_FILE = "response_data"               # Nome base del file con la risposta grezza di Tricount
+DEFAULT_RAW_DUMP = "json"                     # Formato del dump grezzo: "none", "json" (compatto), "pretty" o "gzip"
+CATEGORY_MAP_FILE = "category_map.json"       # Mappatura opzionale categorie Tricount -> categorie Firefly
+CATEGORY_CACHE_SIZE = 1024                    # Categorie grezze distinte memorizzate dalla normalizzazione
+LINKS_FILE = "firefly_links.json"             # UUID Tricount -> ID Firefly e impronta del contenuto (modalità update)
+JOURNAL_FILE = "hashes.journal"               # Journal write-ahead delle importazioni (backend json)
+LOCK_FILE = "tricount-to-firefly.lock"        # Lock contro esecuzioni sovrapposte
+HASH_DB_FILE = "hashes.db"                    # Database SQLite per gli hash (backend sqlite)
+DEFAULT_HASH_BACKEND = "json"                 # Backend per gli hash: "json" o "sqlite"
+REGISTRY_STATE_FILE = "registry_state.json"   # Impronte dei registri Tricount già sincronizzati
+SYNC_STATE_FILE = "sync_state.json"           # File per salvare il watermark della scansione Firefly
+SYNC_OVERLAP_DAYS = 7                         # Giorni di sovrapposizione della scansione incrementale
+FULL_SCAN_INTERVAL_DAYS = 7                   # Ogni quanti giorni forzare una scansione completa
+TRICOUNT_TAG = "tricount"                     # Tag applicato alle transazioni importate
+DEFAULT_WORKERS = 1                           # Numero di richieste parallele verso Firefly III (1 = sequenziale)
+IMPORT_CHUNK_SIZE = 500                       # Richieste preparate per blocco durante l'importazione
+DEFAULT_BATCH_SIZE = 1                        # Transazioni Tricount per richiesta a Firefly III (1 = una per richiesta)
+DEFAULT_WATCH_INTERVAL = 300                  # Secondi tra due sincronizzazioni in modalità --watch
+DEFAULT_WATCH_JITTER = 0.1                    # Variazione casuale dell'intervallo (frazione)
+WATCH_MAX_BACKOFF = 3600                      # Attesa massima (secondi) dopo errori consecutivi
+DEFAULT_POOL_SIZE = 10                        # Connessioni HTTP mantenute aperte per host
+DEFAULT_TIMEOUT = 30                          # Timeout (secondi) delle richieste HTTP
+DEFAULT_RETRIES = 3                           # Tentativi in caso di risposta 429/5xx
+RUN_REPORT_FILE = "run_report.json"           # Report JSON con durate delle fasi e statistiche HTTP
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Limiti (secondi) dell'istogramma delle latenze
+
+def endpoint_label(url):
+    """Riduce un URL a un'etichetta di endpoint stabile, sostituendo ID e UUID con {id}"""
+    segments = [
+        "{id}" if re.fullmatch(r"\d+|[0-9a-fA-F-]{32,36}", segment) else segment
+        for segment in urlparse(url).path.split("/")
+    ]
+    return "/".join(segments) or "/"
+
+class RunMetrics:
+    """Raccoglie durate delle fasi, conteggi e latenze delle richieste HTTP di un'esecuzione"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()  # Fasi aperte nel thread corrente
+        self.reset()
+
+    def reset(self):
+        self.started = datetime.now()
+        self.phases = {}
+        self.endpoints = {}
+        self.retries = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Misura una fase; il tempo delle fasi annidate nello stesso thread viene attribuito solo a queste"""
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            self.add_phase(name, elapsed, nested)
+
+    def add_phase(self, name, seconds, nested=0.0):
+        """Somma la durata di una fase e la toglie dalla fase che la contiene nello stesso thread"""
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            stack[-1] += seconds
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds - nested
+
+    def record_request(self, endpoint, seconds, error=False):
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                "count": 0, "errors": 0, "seconds_sum": 0.0, "buckets": [0] * len(LATENCY_BUCKETS)
+            })
+            stats["count"] += 1
+            stats["seconds_sum"] += seconds
+            if error:
+                stats["errors"] += 1
+            for i, limit in enumerate(LATENCY_BUCKETS):
+                if seconds <= limit:
+                    stats["buckets"][i] += 1
+
+    def record_retry(self, endpoint):
+        with self.lock:
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+
+    def to_dict(self, **extra):
+        with self.lock:
+            report = {
+                "started": self.started.strftime("%Y-%m-%d %H:%M:%S"),
+                "duration_seconds": round((datetime.now() - self.started).total_seconds(), 3),
+                "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+                "http": {
+                    endpoint: {
+                        "count": stats["count"],
+                        "errors": stats["errors"],
+                        "retries": self.retries.get(endpoint, 0),
+                        "seconds_sum": round(stats["seconds_sum"], 4),
+                        "latency_buckets": {str(limit): n for limit, n in zip(LATENCY_BUCKETS, stats["buckets"])}
+                    }
+                    for endpoint, stats in self.endpoints.items()
+                },
+                "retries": dict(self.retries)
+            }
+        report.update(extra)
+        return report
+
+    def write_json(self, path, **extra):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(**extra), f, indent=2)
+        print(f"Report dell'esecuzione salvato in {path}")
+
+    def write_prometheus(self, path, results=None):
+        """Scrive le metriche nel formato textfile di Prometheus (node_exporter)"""
+        report = self.to_dict()
+        lines = [
+            "# TYPE tricount_firefly_last_run_timestamp_seconds gauge",
+            f"tricount_firefly_last_run_timestamp_seconds {time.time():.0f}",
+            "# TYPE tricount_firefly_run_duration_seconds gauge",
+            f"tricount_firefly_run_duration_seconds {report['duration_seconds']}",
+            "# TYPE tricount_firefly_phase_duration_seconds gauge"
+        ]
+        lines += [f'tricount_firefly_phase_duration_seconds{{phase="{name}"}} {seconds}' for name, seconds in report["phases"].items()]
+        lines.append("# TYPE tricount_firefly_http_request_duration_seconds histogram")
+        for endpoint, stats in report["http"].items():
+            for limit, count in stats["latency_buckets"].items():
+                lines.append(f'tricount_firefly_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{limit}"}} {count}')
+            lines.append(f'tricount_firefly_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {stats["count"]}')
+            lines.append(f'tricount_firefly_http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {stats["seconds_sum"]}')
+            lines.append(f'tricount_firefly_http_request_duration_seconds_count{{endpoint="{endpoint}"}} {stats["count"]}')
+        lines.append("# TYPE tricount_firefly_http_errors_total counter")
+        lines += [f'tricount_firefly_http_errors_total{{endpoint="{endpoint}"}} {stats["errors"]}' for endpoint, stats in report["http"].items()]
+        lines.append("# TYPE tricount_firefly_http_retries_total counter")
+        lines += [f'tricount_firefly_http_retries_total{{endpoint="{endpoint}"}} {count}' for endpoint, count in report["retries"].items()]
+        if results:
+            lines.append("# TYPE tricount_firefly_transactions gauge")
+            for result_name, count in results.items():
+                lines.append(f'tricount_firefly_transactions{{result="{result_name}"}} {count}')
+        # Scrittura atomica: node_exporter non deve mai leggere un file a metà
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+        print(f"Metriche Prometheus salvate in {path}")
+
+METRICS = RunMetrics()
+
+class CountingRetry(Retry):
+    """Retry di urllib3 che registra ogni nuovo tentativo nelle metriche"""
+    def increment(self, method=None, url=None, *args, **kwargs):
+        # Solleva MaxRetryError quando i tentativi sono esauriti: l'ultimo fallimento non è un retry
+        retry = super().increment(method, url, *args, **kwargs)
+        METRICS.record_retry(f"{method} {endpoint_label(url or '')}")
+        return retry
+
+class TimeoutSession(requests.Session):
+    """Sessione requests con timeout predefinito su ogni richiesta"""
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = f"{method.upper()} {endpoint_label(url)}"
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, **kwargs)
+        except Exception:
+            METRICS.record_request(endpoint, time.perf_counter() - start, error=True)
+            raise
+        METRICS.record_request(endpoint, time.perf_counter() - start, error=response.status_code >= 400)
+        return response
+
+def create_http_session(pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+    """Crea una sessione HTTP con connessioni persistenti, timeout e retry con backoff"""
+    retry = CountingRetry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = TimeoutSession(timeout)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def session_stats(session):
+    """Restituisce (richieste, connessioni aperte, connessioni riutilizzate) per una sessione"""
+    requests_count = 0
+    connections_count = 0
+    for adapter in set(session.adapters.values()):
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools[key]
+            requests_count += pool.num_requests
+            connections_count += pool.num_connections
+    return requests_count, connections_count, max(0, requests_count - connections_count)
+
+def raw_dump_path(tricount_key, raw_dump, batch=False):
+    """Percorso del dump grezzo per un Tricount (None se il dump è disattivato)"""
+    if raw_dump == "none":
+        return None
+    name = f"{RAW_DUMP_FILE}_{tricount_key}" if batch else RAW_DUMP_FILE
+    return f"{name}.json.gz" if raw_dump == "gzip" else f"{name}.json"
+
+def open_raw_dump(path, raw_dump):
+    """Apre in scrittura binaria il file per il dump grezzo"""
+    if not path:
+        return None
+    return gzip.open(path, 'wb') if raw_dump == "gzip" else open(path, 'wb')
+
+class TeeReader:
+    """Stream in lettura che copia i byte letti su un file di dump"""
+    def __init__(self, source, sink=None):
+        self.source = source
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        if self.sink and data:
+            self.sink.write(data)
+        return data
 
 class TricountAPI:
     """Classe per interagire con l'API di Tricount"""
-    def __init__(self):
-        self.base_url = "https://api.tricount.bunq.com"
-        self.app_installation_id = str(uuid.uuid4())
-        self.public_key, self.private_key = rsa.newkeys(2048)
-        self.rsa_public_key_pem = self.public_key.save_pkcs1(format="PEM").decode()
+    def __init__(self, session=None, credentials_file=TRICOUNT_CREDENTIALS_FILE, base_url=TRICOUNT_BASE_URL):
+        self.base_url = base_url.rstrip('/')
+        self.session = session or create_http_session()
+        self.credentials_file = credentials_file
+        self.auth_lock = threading.Lock()
         self.headers = {
             "User-Agent": "com.bunq.tricount.android:RELEASE:7.0.7:3174:ANDROID:13:C",
-            "app-id": self.app_installation_id,
             "X-Bunq-Client-Request-Id": "049bfcdf-6ae4-4cee-af7b-45da31ea85d0"
         }
         self.auth_token = None
         self.user_id = None
+        self.token_created = None
+        if not self.load_credentials():
+            self.new_installation()
+
+    def new_installation(self):
+        """Genera una nuova installazione (UUID e coppia di chiavi RSA)"""
+        self.app_installation_id = str(uuid.uuid4())
+        self.public_key, self.private_key = rsa.newkeys(2048)
+        self.rsa_public_key_pem = self.public_key.save_pkcs1(format="PEM").decode()
+        self.headers["app-id"] = self.app_installation_id
+        self.headers.pop("X-Bunq-Client-Authentication", None)
+        self.auth_token = None
+        self.user_id = None
+        self.token_created = None
 
-    def authenticate(self):
+    def load_credentials(self):
+        """Carica installazione, chiavi e token dalla cache su disco; False se assenti o non validi"""
+        if not self.credentials_file or not os.path.exists(self.credentials_file):
+            return False
+        try:
+            with open(self.credentials_file, 'r') as f:
+                credentials = json.load(f)
+            if credentials.get("base_url") != self.base_url:
+                return False
+            self.app_installation_id = str(uuid.UUID(credentials["app_installation_id"]))
+            self.private_key = rsa.PrivateKey.load_pkcs1(credentials["private_key"].encode())
+            self.public_key = rsa.PublicKey(self.private_key.n, self.private_key.e)
+            self.rsa_public_key_pem = self.public_key.save_pkcs1(format="PEM").decode()
+            self.headers["app-id"] = self.app_installation_id
+            token_created = credentials.get("token_created")
+            if credentials.get("auth_token") and credentials.get("user_id") and token_created:
+                if datetime.strptime(token_created, "%Y-%m-%d %H:%M:%S") >= datetime.now() - timedelta(days=TRICOUNT_TOKEN_MAX_AGE_DAYS):
+                    self.auth_token = credentials["auth_token"]
+                    self.user_id = credentials["user_id"]
+                    self.token_created = token_created
+                    self.headers["X-Bunq-Client-Authentication"] = self.auth_token
+            return True
+        except Exception as e:
+            print(f"Credenziali Tricount in cache non valide, ne verranno generate di nuove: {str(e)}")
+            return False
+
+    def save_credentials(self):
+        """Salva installazione, chiave privata e token in cache (leggibile solo dall'utente)"""
+        if not self.credentials_file:
+            return
+        credentials = {
+            "base_url": self.base_url,
+            "app_installation_id": self.app_installation_id,
+            "private_key": self.private_key.save_pkcs1(format="PEM").decode(),
+            "auth_token": self.auth_token,
+            "user_id": self.user_id,
+            "token_created": self.token_created
+        }
+        try:
+            fd = os.open(self.credentials_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(credentials, f)
+        except Exception as e:
+            print(f"Errore nel salvataggio delle credenziali Tricount: {str(e)}")
+
+    def authenticate(self, force=False):
+        if self.auth_token and self.user_id and not force:
+            print("Riutilizzo della sessione Tricount in cache")
+            return
         auth_url = f"{self.base_url}/v1/session-registry-installation"
         auth_payload = {
             "app_installation_uuid": self.app_installation_id,
             "client_public_key": self.rsa_public_key_pem,
             "device_description": "Android"
         }
-        response = requests.post(auth_url, json=auth_payload, headers=self.headers)
+        response = self.session.post(auth_url, json=auth_payload, headers=self.headers)
         response.raise_for_status()
         auth_data = response.json()
 
         response_items = auth_data["Response"]
         self.auth_token = next(item["Token"]["token"] for item in response_items if "Token" in item)
         self.user_id = next(item["UserPerson"]["id"] for item in response_items if "UserPerson" in item)
+        self.token_created = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         self.headers["X-Bunq-Client-Authentication"] = self.auth_token
+        self.save_credentials()
+
+    def reauthenticate(self, rejected_token):
+        """Rigenera chiavi e sessione dopo che il server ha rifiutato il token"""
+        with self.auth_lock:
+            if self.auth_token != rejected_token:  # Già rinnovato da un altro thread
+                return
+            print("Token Tricount rifiutato, nuova autenticazione...")
+            self.new_installation()
+            self.authenticate(force=True)
+
+    def get_registry(self, tricount_key, stream=False):
+        for attempt in range(2):
+            # Copia coerente di token, utente e header: reauthenticate li riscrive mentre altri thread scaricano
+            with self.auth_lock:
+                token = self.auth_token
+                user_id = self.user_id
+                headers = dict(self.headers)
+            tricount_url = f"{self.base_url}/v1/user/{user_id}/registry?public_identifier_token={tricount_key}"
+            response = self.session.get(tricount_url, headers=headers, stream=stream)
+            if response.status_code in (401, 403) and attempt == 0:
+                response.close()
+                self.reauthenticate(token)
+                continue
+            response.raise_for_status()
+            return response
 
     def fetch_tricount_data(self, tricount_key):
-        tricount_url = f"{self.base_url}/v1/user/{self.user_id}/registry?public_identifier_token={tricount_key}"
-        response = requests.get(tricount_url, headers=self.headers)
-        response.raise_for_status()
-        return response.json()
+        return self.get_registry(tricount_key).json()
+
+    def stream_tricount_data(self, tricount_key):
+        """Restituisce la risposta del registro senza leggerne il corpo (da chiudere dopo l'uso)"""
+        response = self.get_registry(tricount_key, stream=True)
+        response.raw.decode_content = True
+        return response
+
+EMOJI_PATTERN = re.compile("["
+                           u"\U0001F600-\U0001F64F"
+                           u"\U0001F300-\U0001F5FF"
+                           u"\U0001F680-\U0001F6FF"
+                           u"\U0001F700-\U0001F77F"
+                           u"\U0001F780-\U0001F7FF"
+                           u"\U0001F800-\U0001F8FF"
+                           u"\U0001F900-\U0001F9FF"
+                           u"\U0001FA00-\U0001FA6F"
+                           u"\U0001FA70-\U0001FAFF"
+                           u"\U00002702-\U000027B0"
+                           u"\U000024C2-\U0001F251"
+                           u"\U0000200D"
+                           u"\U0000FE0F"
+                           "]+", flags=re.UNICODE)
+
+@dataclass
+class TricountTransaction:
+    """Transazione Tricount normalizzata, pronta per l'esportazione e l'importazione"""
+    __slots__ = ("uuid", "type", "who_paid", "total", "currency", "description", "when", "shares", "raw_category", "category", "updated")
+    uuid: str
+    type: str
+    who_paid: str
+    total: float
+    currency: str
+    description: str
+    when: str
+    shares: dict
+    raw_category: str
+    category: str
+    updated: str
+
+    @property
+    def date(self):
+        """Data della transazione in formato YYYY-MM-DD"""
+        return self.when[:10] if self.when else datetime.now().strftime('%Y-%m-%d')
+
+    @property
+    def involved(self):
+        return ", ".join([name for name, amount in self.shares.items() if amount > 0])
+
+    def content_hash(self):
+        """Impronta del contenuto: cambia quando la voce viene modificata su Tricount"""
+        shares = ",".join(f"{name}={amount}" for name, amount in sorted(self.shares.items()))
+        content = f"{self.updated}|{self.type}|{self.who_paid}|{self.total}|{self.currency}|{self.description}|{self.when}|{shares}|{self.raw_category}|{self.category}"
+        return hashlib.md5(content.encode()).hexdigest()
 
 class TricountHandler:
     """Gestisce i dati Tricount (parsing, pulizia, esportazione)"""
@@ -61,90 +451,547 @@ class TricountHandler:
     def get_tricount_title(data):
         return data["Response"][0]["Registry"]["title"]
     
+    category_map = {}  # Categoria Tricount ripulita (minuscolo) -> categoria Firefly
+
+    @staticmethod
+    def load_category_map(path=CATEGORY_MAP_FILE):
+        """Carica la mappatura JSON {categoria Tricount: categoria Firefly}, una sola volta per esecuzione"""
+        category_map = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    for tricount_name, firefly_name in json.load(f).items():
+                        category_map[TricountHandler.clean_category(tricount_name).lower()] = firefly_name
+                print(f"Caricate {len(category_map)} mappature di categorie da {path}")
+            except Exception as e:
+                print(f"Errore nel caricamento della mappatura categorie da {path}: {str(e)}")
+        elif path and path != CATEGORY_MAP_FILE:
+            # I percorsi relativi partono dalla cartella di lavoro, non da quella dello script
+            print(f"Attenzione: mappatura categorie {os.path.abspath(path)} non trovata, categorie usate senza mappatura")
+        TricountHandler.category_map = category_map
+        TricountHandler.normalize_category.cache_clear()
+
     @staticmethod
     def clean_category(category):
         if not category:
             return ""
-        emoji_pattern = re.compile("["
-                                   u"\U0001F600-\U0001F64F"
-                                   u"\U0001F300-\U0001F5FF"
-                                   u"\U0001F680-\U0001F6FF"
-                                   u"\U0001F700-\U0001F77F"
-                                   u"\U0001F780-\U0001F7FF"
-                                   u"\U0001F800-\U0001F8FF"
-                                   u"\U0001F900-\U0001F9FF"
-                                   u"\U0001FA00-\U0001FA6F"
-                                   u"\U0001FA70-\U0001FAFF"
-                                   u"\U00002702-\U000027B0"
-                                   u"\U000024C2-\U0001F251"
-                                   u"\U0000200D"
-                                   u"\U0000FE0F"
-                                   "]+", flags=re.UNICODE)
-        clean_text = emoji_pattern.sub(r'', category).strip()
+        clean_text = EMOJI_PATTERN.sub(r'', category).strip()
         return clean_text[0].upper() + clean_text[1:].lower() if clean_text else clean_text
 
+    @staticmethod
+    @lru_cache(maxsize=CATEGORY_CACHE_SIZE)
+    def normalize_category(raw_category):
+        """Categoria Firefly per una categoria Tricount grezza (memorizzata: un registro ne usa poche)"""
+        clean_text = TricountHandler.clean_category(raw_category)
+        return TricountHandler.category_map.get(clean_text.lower(), clean_text)
+
+    @staticmethod
+    def parse_registry_entry(entry):
+        transaction = entry["RegistryEntry"]
+        type_transaction = transaction["type_transaction"]
+        who_paid = transaction["membership_owned"]["RegistryMembershipNonUser"]["alias"]["display_name"]
+        total = float(transaction["amount"]["value"]) * -1
+        currency = transaction["amount"]["currency"]
+        description = transaction.get("description", "")
+        when = transaction["date"]
+        shares = {
+            alloc["membership"]["RegistryMembershipNonUser"]["alias"]["display_name"]: abs(float(alloc["amount"]["value"]))
+            for alloc in transaction["allocations"]
+        }
+        uuid = transaction["uuid"]
+        raw_category = transaction["category_custom"] if transaction["category_custom"] is not None else transaction["category"]
+        cleaned_category = TricountHandler.normalize_category(raw_category)
+        
+        return TricountTransaction(
+            uuid=uuid,
+            type=type_transaction,
+            who_paid=who_paid,
+            total=total,
+            currency=currency,
+            description=description,
+            when=when,
+            shares=shares,
+            raw_category=raw_category,
+            category=cleaned_category,
+            updated=transaction.get("updated") or ""
+        )
+
     @staticmethod
     def parse_tricount_data(data):
         registry = data["Response"][0]["Registry"]
-        transactions = []
-        for entry in registry["all_registry_entry"]:
-            transaction = entry["RegistryEntry"]
-            type_transaction = transaction["type_transaction"]
-            who_paid = transaction["membership_owned"]["RegistryMembershipNonUser"]["alias"]["display_name"]
-            total = float(transaction["amount"]["value"]) * -1
-            currency = transaction["amount"]["currency"]
-            description = transaction.get("description", "")
-            when = transaction["date"]
-            shares = {
-                alloc["membership"]["RegistryMembershipNonUser"]["alias"]["display_name"]: abs(float(alloc["amount"]["value"]))
-                for alloc in transaction["allocations"]
-            }
-            uuid = transaction["uuid"]
-            raw_category = transaction["category_custom"] if transaction["category_custom"] is not None else transaction["category"]
-            cleaned_category = TricountHandler.clean_category(raw_category)
-            
-            transactions.append({
-                "UUID": uuid,
-                "Type": type_transaction,
-                "Who Paid": who_paid,
-                "Total": total,
-                "Currency": currency,
-                "Description": description,
-                "When": when,
-                "Shares": shares,
-                "RawCategory": raw_category,
-                "Category": cleaned_category
-            })
-        return transactions
+        return [TricountHandler.parse_registry_entry(entry) for entry in registry["all_registry_entry"]]
 
     @staticmethod
-    def write_to_excel(transactions, file_name):
-        transactions_data = []
+    def iter_tricount_data(stream, registry_info):
+        """Legge il registro in modo incrementale con ijson e restituisce una transazione alla volta.
+
+        Il titolo del registro viene salvato in registry_info['title'] appena incontrato.
+        """
+        entry_prefix = "Response.item.Registry.all_registry_entry.item"
+        events = ijson.parse(stream)
+        for prefix, event, value in events:
+            if prefix == "Response.item.Registry.title" and event == "string":
+                registry_info.setdefault("title", value)
+            elif prefix == entry_prefix and event == "start_map":
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                for prefix, event, value in events:
+                    builder.event(event, value)
+                    if prefix == entry_prefix and event == "end_map":
+                        break
+                yield TricountHandler.parse_registry_entry(builder.value)
+
+    EXPORT_COLUMNS = ("UUID", "Who Paid", "Total", "Currency", "Description", "When", "Involved", "Category")
+
+    @staticmethod
+    def export_rows(transactions):
+        """Righe dell'export nell'ordine di EXPORT_COLUMNS"""
         for transaction in transactions:
-            involved = ", ".join([name for name, amount in transaction["Shares"].items() if amount > 0])
-            row_data = {
-                "UUID": transaction["UUID"],
-                "Who Paid": transaction["Who Paid"],
-                "Total": abs(transaction["Total"]),
-                "Currency": transaction["Currency"],
-                "Description": transaction["Description"],
-                "When": datetime.strptime(transaction["When"], "%Y-%m-%d %H:%M:%S.%f").strftime("%Y-%m-%d"),
-                "Involved": involved,
-                "Category": transaction["Category"]
-            }
-            transactions_data.append(row_data)
+            yield (
+                transaction.uuid,
+                transaction.who_paid,
+                abs(transaction.total),
+                transaction.currency,
+                transaction.description,
+                # "when" è già ISO (YYYY-MM-DD HH:MM:SS.ffffff): basta troncarlo, senza strptime
+                (transaction.when or "")[:10],
+                transaction.involved,
+                transaction.category
+            )
+
+    @staticmethod
+    def export_dataframe(transactions):
+        # pandas serve solo per Excel e Parquet: importato qui per non rallentare l'avvio
+        import pandas as pd
+        return pd.DataFrame.from_records(list(TricountHandler.export_rows(transactions)), columns=TricountHandler.EXPORT_COLUMNS)
 
-        df = pd.DataFrame(transactions_data)
-        df.to_excel(f"{file_name}.xlsx", index=False)
-        print(f"Transazioni salvate in {file_name}.xlsx")
-        return df
+    @staticmethod
+    def write_to_excel(transactions, file_name):
+        path = f"{file_name}.xlsx"
+        TricountHandler.export_dataframe(transactions).to_excel(path, index=False)
+        return path
+
+    @staticmethod
+    def write_to_parquet(transactions, file_name):
+        # Richiede pyarrow (o fastparquet) oltre a pandas
+        path = f"{file_name}.parquet"
+        TricountHandler.export_dataframe(transactions).to_parquet(path, index=False)
+        return path
+
+    @staticmethod
+    def write_to_csv(transactions, file_name):
+        path = f"{file_name}.csv"
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(TricountHandler.EXPORT_COLUMNS)
+            writer.writerows(TricountHandler.export_rows(transactions))
+        return path
+
+    @staticmethod
+    def write_to_jsonl(transactions, file_name):
+        path = f"{file_name}.jsonl"
+        with open(path, 'w', encoding='utf-8') as f:
+            for row in TricountHandler.export_rows(transactions):
+                f.write(json.dumps(dict(zip(TricountHandler.EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n")
+        return path
+
+EXPORT_FORMATS = {
+    "xlsx": TricountHandler.write_to_excel,
+    "csv": TricountHandler.write_to_csv,
+    "jsonl": TricountHandler.write_to_jsonl,
+    "parquet": TricountHandler.write_to_parquet,
+}
+
+class ExportStream:
+    """Coda delle transazioni verso il thread di export di un Tricount letto in streaming"""
+    def __init__(self, tricount_key):
+        self.tricount_key = tricount_key
+        self.queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        # Il titolo del Tricount si conosce solo a fine lettura: si scrive su un file temporaneo
+        self.file_name = f".Transactions {tricount_key}.partial"
+        self.title = None
+        self.wait_seconds = 0.0
+
+    def put(self, transaction):
+        self.queue.put(transaction)
+
+    def close(self, tricount_title=None):
+        """Termina l'export; senza titolo (lettura interrotta) il file parziale viene eliminato"""
+        self.title = tricount_title
+        self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            start = time.perf_counter()
+            transaction = self.queue.get()
+            self.wait_seconds += time.perf_counter() - start
+            if transaction is None:
+                return
+            yield transaction
+
+class BackgroundExporter:
+    """Scrive gli export in un thread separato, in parallelo all'importazione in Firefly III"""
+    def __init__(self, export_format=DEFAULT_EXPORT_FORMAT):
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Formato di export sconosciuto: {export_format}")
+        self.writer = EXPORT_FORMATS[export_format]
+        self.threads = []
+
+    def submit(self, transactions, tricount_title):
+        # Le transazioni non vengono modificate dopo il parsing: il thread può leggerle mentre si importa
+        thread = threading.Thread(target=self.export, args=(transactions, f"Transactions {tricount_title}"), name="export")
+        thread.start()
+        self.threads.append(thread)
+
+    def export(self, transactions, file_name):
+        try:
+            with METRICS.phase("export"):
+                path = self.writer(transactions, file_name)
+            print(f"Transazioni salvate in {path}")
+        except Exception as e:
+            print(f"Errore nell'export di {file_name}: {str(e)}")
+
+    def open_stream(self, tricount_key):
+        """Avvia l'export di un Tricount letto in streaming; le righe arrivano con ExportStream.put"""
+        stream = ExportStream(tricount_key)
+        thread = threading.Thread(target=self.export_stream, args=(stream,), name="export")
+        thread.start()
+        self.threads.append(thread)
+        return stream
+
+    def export_stream(self, stream):
+        start = time.perf_counter()
+        try:
+            path = self.writer(stream, stream.file_name)
+        except Exception as e:
+            print(f"Errore nell'export del Tricount {stream.tricount_key}: {str(e)}")
+            path = None
+            # La coda va svuotata comunque, altrimenti l'importazione resterebbe bloccata
+            for _ in stream:
+                pass
+        # Il tempo passato in attesa delle righe appartiene all'importazione, non all'export
+        METRICS.add_phase("export", time.perf_counter() - start - stream.wait_seconds)
+        if path is None or stream.title is None:
+            for partial in glob.glob(glob.escape(stream.file_name) + ".*"):
+                os.remove(partial)
+            return
+        final_path = f"Transactions {stream.title}{os.path.splitext(path)[1]}"
+        os.replace(path, final_path)
+        print(f"Transazioni salvate in {final_path}")
+
+    def close(self):
+        """Attende la fine degli export in corso"""
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+class RegistryState:
+    """Impronte dei registri Tricount già sincronizzati, per saltare Firefly quando nulla è cambiato.
+
+    Senza path (--no-change-detection) non registra nulla e ogni voce risulta modificata,
+    anche quando l'istanza viene riutilizzata tra le esecuzioni di --watch.
+    """
+    def __init__(self, path=REGISTRY_STATE_FILE, firefly_host=None):
+        self.path = path
+        self.firefly_host = firefly_host.rstrip('/') if firefly_host else None
+        self.registries = {}  # chiave Tricount -> {"fingerprint": ..., "entries": {UUID: impronta}}
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            # Le impronte valgono solo per l'istanza Firefly in cui sono state importate
+            if state.get("firefly_host") == self.firefly_host:
+                self.registries = state.get("registries", {})
+        except Exception as e:
+            print(f"Errore nel caricamento delle impronte da {self.path}: {str(e)}")
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({"firefly_host": self.firefly_host, "registries": self.registries}, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Errore nel salvataggio delle impronte: {str(e)}")
+
+    @staticmethod
+    def fingerprint(entries):
+        digest = hashlib.sha256()
+        for uuid_value in sorted(entries):
+            digest.update(f"{uuid_value}:{entries[uuid_value]};".encode())
+        return digest.hexdigest()
+
+    def known_entries(self, tricount_key):
+        return self.registries.get(tricount_key, {}).get("entries", {})
+
+    def is_changed(self, tricount_key, transaction):
+        if not self.path:
+            return True
+        return self.known_entries(tricount_key).get(transaction.uuid) != transaction.content_hash()
+
+    def changed_transactions(self, tricount_key, transactions):
+        """Restituisce solo le voci nuove o modificate dall'ultima sincronizzazione"""
+        state = self.registries.get(tricount_key) if self.path else None
+        if not state:
+            return list(transactions)
+        entries = {t.uuid: t.content_hash() for t in transactions if t.uuid}
+        if self.fingerprint(entries) == state.get("fingerprint") and len(entries) == len(transactions):
+            return []
+        known = state.get("entries", {})
+        return [t for t in transactions if not t.uuid or known.get(t.uuid) != entries[t.uuid]]
+
+    def removed_uuids(self, tricount_key, transactions):
+        """UUID sincronizzati in precedenza che non sono più nel registro"""
+        current = {t.uuid for t in transactions}
+        return [uuid_value for uuid_value in self.known_entries(tricount_key) if uuid_value not in current]
+
+    def update(self, tricount_key, entries, failed=()):
+        """Registra le impronte delle voci sincronizzate; quelle fallite verranno ritentate"""
+        if not self.path:
+            return
+        entries = {uuid_value: digest for uuid_value, digest in entries.items() if uuid_value not in failed}
+        self.registries[tricount_key] = {"fingerprint": self.fingerprint(entries), "entries": entries}
+
+class JsonHashStore:
+    """Salva gli UUID importati in un file JSON (UUID -> data).
+
+    Ogni importazione riuscita viene scritta subito (con fsync) in un journal append-only:
+    se il processo si interrompe prima di save(), la run successiva riparte dal journal.
+    """
+    def __init__(self, path=HASH_FILE, links_path=LINKS_FILE, journal_path=JOURNAL_FILE):
+        self.path = path
+        self.links_path = links_path
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        self.journal = None
+        self.links_pending = False  # Il journal contiene collegamenti non ancora scritti in links_path
+
+    def read_journal(self):
+        """Restituisce le operazioni registrate nel journal (una riga JSON ciascuna)"""
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return []
+        operations = []
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                try:
+                    operations.append(json.loads(line))
+                except ValueError:
+                    break  # Ultima riga troncata da un crash durante la scrittura
+        return operations
+
+    def append_journal(self, operation):
+        if not self.journal_path:
+            return
+        with self.lock:
+            if self.journal is None:
+                self.journal = open(self.journal_path, 'a')
+            self.journal.write(json.dumps(operation, separators=(',', ':')) + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def load(self):
+        hashes = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                hashes = json.load(f)
+        recovered = 0
+        for operation in self.read_journal():
+            if operation.get("op") in ("link", "unlink"):
+                self.links_pending = True
+            if operation.get("op") == "add":
+                hashes[operation["uuid"]] = operation["date"]
+                recovered += 1
+            elif operation.get("op") == "remove":
+                hashes.pop(operation["uuid"], None)
+        if recovered:
+            print(f"Recuperati {recovered} UUID dal journal {self.journal_path} (esecuzione precedente interrotta)")
+        return hashes
+
+    def add(self, uuid_value, date):
+        self.append_journal({"op": "add", "uuid": uuid_value, "date": date})
+
+    def remove(self, uuid_value):
+        self.append_journal({"op": "remove", "uuid": uuid_value})
+
+    @staticmethod
+    def write_json(path, data):
+        # Scrittura su file temporaneo e rename atomico: un crash non corrompe il file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def save(self, hashes):
+        self.write_json(self.path, hashes)
+
+    def prune(self, cutoff, hashes):
+        self.save(hashes)
+
+    def load_links(self):
+        links = {}
+        if os.path.exists(self.links_path):
+            with open(self.links_path, 'r') as f:
+                links = json.load(f)
+        for operation in self.read_journal():
+            if operation.get("op") == "link":
+                links[operation["uuid"]] = operation["link"]
+            elif operation.get("op") == "unlink":
+                links.pop(operation["uuid"], None)
+        return links
+
+    def set_link(self, uuid_value, link):
+        self.append_journal({"op": "link", "uuid": uuid_value, "link": link})
+        self.links_pending = True
+
+    def remove_link(self, uuid_value):
+        self.append_journal({"op": "unlink", "uuid": uuid_value})
+        self.links_pending = True
+
+    def save_links(self, links):
+        self.write_json(self.links_path, links)
+        self.links_pending = False
+
+    def checkpoint(self):
+        """Svuota il journal dopo che hashes e collegamenti sono stati salvati su file"""
+        if self.links_pending:
+            # Senza --update i collegamenti non vengono salvati da save_links: quelli del journal
+            # (anche di un'esecuzione interrotta) vanno riportati nel file prima di eliminarlo
+            self.save_links(self.load_links())
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if self.journal_path and os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+class SqliteHashStore:
+    """Salva gli UUID importati in un database SQLite indicizzato su UUID e data"""
+    def __init__(self, path=HASH_DB_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.persisted = {}
+        self.persisted_links = {}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS hashes (uuid TEXT PRIMARY KEY, date TEXT NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_hashes_date ON hashes (date)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS links (uuid TEXT PRIMARY KEY, firefly_id TEXT NOT NULL, content_hash TEXT, tricount TEXT)")
+        self.conn.commit()
+
+    def load(self):
+        with self.lock:
+            self.persisted = dict(self.conn.execute("SELECT uuid, date FROM hashes"))
+        if not self.persisted and os.path.exists(HASH_FILE):
+            # Migrazione una tantum dal vecchio hashes.json
+            hashes = JsonHashStore(HASH_FILE).load()
+            self.save(hashes)
+            print(f"Migrati {len(hashes)} UUID da {HASH_FILE} a {self.path}")
+        return dict(self.persisted)
+
+    def add(self, uuid_value, date):
+        """Inserisce subito un singolo UUID importato, con commit atomico"""
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO hashes (uuid, date) VALUES (?, ?)", (uuid_value, date))
+            self.persisted[uuid_value] = date
+
+    def save(self, hashes):
+        """Scrive solo gli UUID nuovi o modificati rispetto al database"""
+        with self.lock:
+            changed = [(k, v) for k, v in hashes.items() if self.persisted.get(k) != v]
+            if not changed:
+                return
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO hashes (uuid, date) VALUES (?, ?)", changed)
+            self.persisted.update(changed)
+
+    def remove(self, uuid_value):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM hashes WHERE uuid = ?", (uuid_value,))
+            self.persisted.pop(uuid_value, None)
+
+    def prune(self, cutoff, hashes):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM hashes WHERE date <= ?", (cutoff,))
+            self.persisted = {k: v for k, v in self.persisted.items() if v > cutoff}
+
+    def load_links(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT uuid, firefly_id, content_hash, tricount FROM links").fetchall()
+        links = {row[0]: {"id": row[1], "hash": row[2], "tricount": row[3]} for row in rows}
+        self.persisted_links = {k: dict(v) for k, v in links.items()}
+        return links
+
+    def set_link(self, uuid_value, link):
+        """Salva subito il collegamento UUID -> transazione Firefly"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO links (uuid, firefly_id, content_hash, tricount) VALUES (?, ?, ?, ?)",
+                (uuid_value, link["id"], link.get("hash"), link.get("tricount"))
+            )
+            self.persisted_links[uuid_value] = dict(link)
+
+    def remove_link(self, uuid_value):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM links WHERE uuid = ?", (uuid_value,))
+            self.persisted_links.pop(uuid_value, None)
+
+    def save_links(self, links):
+        """Scrive solo i collegamenti nuovi o modificati rispetto al database"""
+        with self.lock:
+            changed = [
+                (k, v["id"], v.get("hash"), v.get("tricount"))
+                for k, v in links.items() if self.persisted_links.get(k) != v
+            ]
+            if not changed:
+                return
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO links (uuid, firefly_id, content_hash, tricount) VALUES (?, ?, ?, ?)", changed
+                )
+            self.persisted_links.update((k, dict(links[k])) for k, *_ in changed)
+
+    def checkpoint(self):
+        # Ogni operazione è già confermata nel database
+        pass
+
+    def close(self):
+        self.conn.close()
+
+HASH_STORES = {
+    "json": JsonHashStore,
+    "sqlite": SqliteHashStore,
+}
+
+def create_hash_store(backend=DEFAULT_HASH_BACKEND):
+    """Restituisce il backend per lo stato di deduplicazione"""
+    if backend not in HASH_STORES:
+        raise ValueError(f"Backend hash sconosciuto: {backend}")
+    return HASH_STORES[backend]()
 
 class FireflyIIIImporter:
     """Classe per importare transazioni in Firefly III"""
-    def __init__(self, host, api_token, days_range=DEFAULT_DAYS_RANGE):
+    def __init__(self, host, api_token, days_range=DEFAULT_DAYS_RANGE, workers=DEFAULT_WORKERS, pool_size=DEFAULT_POOL_SIZE, full_scan=False, hash_store=None, update_mode=False, batch_size=DEFAULT_BATCH_SIZE):
         self.host = host.rstrip('/')
         self.api_token = api_token
         self.days_range = days_range
+        self.full_scan = full_scan
+        self.update_mode = update_mode
+        # In modalità update ogni voce deve restare un gruppo Firefly a sé (PUT/DELETE per ID)
+        self.batch_size = 1 if update_mode else max(1, batch_size)
+        self.workers = max(1, workers)
+        # Il pool deve contenere almeno una connessione per worker
+        self.session = create_http_session(pool_size=max(pool_size, self.workers))
         self.headers = {
             'Authorization': f'Bearer {self.api_token}',
             'Content-Type': 'application/json',
@@ -153,9 +1000,16 @@ class FireflyIIIImporter:
         self.verify_connection()
         
         self.accounts_cache = {}
-        self.categories_cache = {}
+        self.categories_cache = {}  # Nome categoria (minuscolo) -> ID Firefly
+        self.failed_categories = set()
+        self.failed_uuids = set()  # UUID la cui importazione è fallita in questa esecuzione
+        self.links = {}  # UUID -> {"id": ID Firefly, "hash": impronta del contenuto, "tricount": chiave}
+        self.sync_stats = {"updated": 0, "deleted": 0}
         self.duplicate_hashes = {}  # Dizionario per salvare UUID e data
+        self.hashes_lock = threading.Lock()
+        self.hash_store = hash_store or create_hash_store()
         self.transactions_loaded = False
+        self.sync_state = {}
         
         self.default_account_id = DEFAULT_ACCOUNT_ID
         if not self.default_account_id:
@@ -166,11 +1020,23 @@ class FireflyIIIImporter:
             exit(1)
             
         self.load_existing_hashes()
-        self.load_existing_transactions()
+        self.load_sync_state()
+        with METRICS.phase("existing_scan"):
+            self.load_existing_transactions()
+        with METRICS.phase("category_resolution"):
+            self.load_categories()
+
+    def start_run(self):
+        """Prepara un importatore già inizializzato (modalità --watch) per una nuova esecuzione"""
+        self.failed_uuids = set()
+        self.sync_stats = {"updated": 0, "deleted": 0}
+        if not self.transactions_loaded:
+            with METRICS.phase("existing_scan"):
+                self.load_existing_transactions()
 
     def verify_connection(self):
         try:
-            response = requests.get(f"{self.host}/api/v1/about", headers=self.headers)
+            response = self.session.get(f"{self.host}/api/v1/about", headers=self.headers)
             response.raise_for_status()
             print(f"Connessione riuscita a Firefly III v{response.json()['data']['version']}")
         except Exception as e:
@@ -179,7 +1045,7 @@ class FireflyIIIImporter:
 
     def find_default_account(self):
         try:
-            response = requests.get(
+            response = self.session.get(
                 f"{self.host}/api/v1/accounts",
                 headers=self.headers,
                 params={'type': 'asset'}
@@ -193,54 +1059,112 @@ class FireflyIIIImporter:
             print(f"Errore nella ricerca dell'account: {str(e)}")
 
     def load_existing_hashes(self):
-        """Carica gli UUID delle transazioni precedenti da file locale"""
-        if os.path.exists(HASH_FILE):
+        """Carica gli UUID delle transazioni precedenti dallo store locale"""
+        try:
+            self.duplicate_hashes = self.hash_store.load()
+            if self.duplicate_hashes:
+                print(f"Caricati {len(self.duplicate_hashes)} UUID da {self.hash_store.path}")
+        except Exception as e:
+            print(f"Errore nel caricamento degli UUID da {self.hash_store.path}: {str(e)}")
+            self.duplicate_hashes = {}
+        if self.update_mode:
             try:
-                with open(HASH_FILE, 'r') as f:
-                    self.duplicate_hashes = json.load(f)
-                print(f"Caricati {len(self.duplicate_hashes)} UUID da {HASH_FILE}")
+                self.links = self.hash_store.load_links()
             except Exception as e:
-                print(f"Errore nel caricamento degli UUID da {HASH_FILE}: {str(e)}")
-                self.duplicate_hashes = {}
+                print(f"Errore nel caricamento dei collegamenti Firefly: {str(e)}")
+                self.links = {}
 
     def save_hashes(self):
-        """Salva gli UUID su file locale"""
+        """Salva gli UUID nello store locale"""
         try:
-            with open(HASH_FILE, 'w') as f:
-                json.dump(self.duplicate_hashes, f, indent=2)
-            print(f"Salvati {len(self.duplicate_hashes)} UUID in {HASH_FILE}")
+            with self.hashes_lock:
+                hashes = dict(self.duplicate_hashes)
+                links = dict(self.links)
+            self.hash_store.save(hashes)
+            if self.update_mode:
+                self.hash_store.save_links(links)
+            self.hash_store.checkpoint()
+            print(f"Salvati {len(self.duplicate_hashes)} UUID in {self.hash_store.path}")
         except Exception as e:
             print(f"Errore nel salvataggio degli UUID: {str(e)}")
+            return
+        if self.transactions_loaded:
+            self.save_sync_state()
 
     def clean_duplicate_hashes(self):
         """Pulisce gli UUID, mantenendo solo quelli degli ultimi days_range giorni"""
-        cutoff_date = datetime.now() - timedelta(days=self.days_range)
+        # Le date sono in formato ISO (YYYY-MM-DD): il confronto tra stringhe evita strptime
+        cutoff = (datetime.now() - timedelta(days=self.days_range)).strftime('%Y-%m-%d')
         original_count = len(self.duplicate_hashes)
         self.duplicate_hashes = {
             uuid_value: date 
             for uuid_value, date in self.duplicate_hashes.items()
-            if datetime.strptime(date, "%Y-%m-%d") >= cutoff_date
+            if date > cutoff
         }
         cleaned_count = len(self.duplicate_hashes)
         print(f"Pulizia degli UUID: {original_count} UUID iniziali, {cleaned_count} mantenuti dopo il filtro di {self.days_range} giorni")
-        self.save_hashes()
+        try:
+            self.hash_store.prune(cutoff, self.duplicate_hashes)
+        except Exception as e:
+            print(f"Errore nella pulizia degli UUID: {str(e)}")
+            return
+        if self.transactions_loaded:
+            self.save_sync_state()
+
+    def load_sync_state(self):
+        """Carica il watermark dell'ultima scansione Firefly da file locale"""
+        if os.path.exists(SYNC_STATE_FILE):
+            try:
+                with open(SYNC_STATE_FILE, 'r') as f:
+                    state = json.load(f)
+                if state.get('host') == self.host:
+                    self.sync_state = state
+            except Exception as e:
+                print(f"Errore nel caricamento dello stato di sincronizzazione da {SYNC_STATE_FILE}: {str(e)}")
+
+    def save_sync_state(self):
+        """Salva il watermark della scansione Firefly su file locale"""
+        try:
+            with open(SYNC_STATE_FILE, 'w') as f:
+                json.dump(self.sync_state, f)
+        except Exception as e:
+            print(f"Errore nel salvataggio dello stato di sincronizzazione: {str(e)}")
+
+    def scan_start_date(self):
+        """Data di inizio della scansione: incrementale dal watermark o completa su days_range giorni"""
+        today = datetime.now()
+        full_start = today - timedelta(days=self.days_range)
+        last_sync = self.sync_state.get('last_sync')
+        last_full_scan = self.sync_state.get('last_full_scan')
+        if self.full_scan or not last_sync or not last_full_scan or not self.duplicate_hashes:
+            return full_start, True
+        if datetime.strptime(last_full_scan, "%Y-%m-%d") < today - timedelta(days=FULL_SCAN_INTERVAL_DAYS):
+            return full_start, True
+        incremental_start = datetime.strptime(last_sync, "%Y-%m-%d") - timedelta(days=SYNC_OVERLAP_DAYS)
+        return max(incremental_start, full_start), False
 
     def load_existing_transactions(self, start_date=None, end_date=None):
-        """Carica le transazioni esistenti da Firefly III usando solo UUID"""
+        """Carica le transazioni esistenti da Firefly III con il tag tricount usando solo UUID"""
         print("Caricamento delle transazioni esistenti da Firefly III...")
+        is_full_scan = False
         if not start_date or not end_date:
-            start_date = (datetime.now() - timedelta(days=self.days_range)).strftime('%Y-%m-%d')
+            start, is_full_scan = self.scan_start_date()
+            start_date = start.strftime('%Y-%m-%d')
             end_date = datetime.now().strftime('%Y-%m-%d')
+            print(f"Scansione {'completa' if is_full_scan else 'incrementale'} dal {start_date} al {end_date}")
         page = 1
-        params = {'page': page, 'start': start_date, 'end': end_date}
+        params = {'page': page, 'start': start_date, 'end': end_date, 'type': 'withdrawal'}
         
         while True:
             try:
-                response = requests.get(
-                    f"{self.host}/api/v1/transactions",
+                # Filtro lato server: solo le transazioni con il tag tricount
+                response = self.session.get(
+                    f"{self.host}/api/v1/tags/{TRICOUNT_TAG}/transactions",
                     headers=self.headers,
                     params=params
                 )
+                if response.status_code == 404:  # Tag non ancora creato: nessuna transazione importata
+                    break
                 response.raise_for_status()
                 data = response.json()
                 transactions = data['data']
@@ -249,11 +1173,14 @@ class FireflyIIIImporter:
                     break
                     
                 for transaction in transactions:
-                    for split in transaction['attributes']['transactions']:
+                    splits = transaction['attributes']['transactions']
+                    for split in splits:
                         date = split['date'].split('T')[0]
                         external_id = split.get('external_id', '')
-                        if external_id and "tricount" in split.get('tags', []):  # Considera solo transazioni da Tricount
+                        if external_id and TRICOUNT_TAG in split.get('tags', []):  # Considera solo transazioni da Tricount
                             self.duplicate_hashes[external_id] = date
+                            if self.update_mode:
+                                self.scan_link(external_id, transaction['id'], split.get('transaction_journal_id'), len(splits) > 1)
                 
                 if data['meta']['pagination']['current_page'] >= data['meta']['pagination']['total_pages']:
                     break
@@ -263,10 +1190,25 @@ class FireflyIIIImporter:
             except Exception as e:
                 print(f"Errore nel caricamento delle transazioni: {str(e)}")
                 return
-                
+        
+        # Il watermark viene reso persistente insieme agli UUID in save_hashes
+        self.sync_state['host'] = self.host
+        self.sync_state['last_sync'] = end_date
+        if is_full_scan:
+            self.sync_state['last_full_scan'] = end_date
         self.transactions_loaded = True
         print(f"Caricate {len(self.duplicate_hashes)} transazioni totali (Firefly + locali)")
 
+    def scan_link(self, uuid, group_id, journal_id, split):
+        """Registra (o aggiorna) il collegamento di una voce trovata nella scansione Firefly"""
+        link = self.links.get(uuid)
+        if link is None:
+            # Impronta e Tricount vengono completati da adopt_link al primo passaggio del registro
+            self.links[uuid] = {"id": str(group_id), "journal": journal_id and str(journal_id), "split": split, "hash": None, "tricount": None}
+        elif link["id"] == str(group_id):
+            # La struttura del gruppo in Firefly è quella aggiornata (es. gruppi creati con --batch-size)
+            link.update(journal=journal_id and str(journal_id), split=split)
+
     def create_transaction_hash(self, date, description, amount, category, uuid=None):
         """Restituisce l'UUID se presente, altrimenti genera un hash"""
         if uuid:
@@ -274,197 +1216,852 @@ class FireflyIIIImporter:
         hash_input = f"{date}|{description.strip().lower()}|{amount}|{category.strip().lower()}"
         return hashlib.md5(hash_input.encode()).hexdigest()
 
-    def get_or_create_category(self, name):
-        if not name or name.strip() == "":
+    def load_categories(self):
+        """Carica tutte le pagine delle categorie Firefly in un indice case-insensitive"""
+        page = 1
+        params = {'page': page}
+        while True:
+            try:
+                response = self.session.get(
+                    f"{self.host}/api/v1/categories",
+                    headers=self.headers,
+                    params=params
+                )
+                response.raise_for_status()
+                data = response.json()
+                for category in data['data']:
+                    self.categories_cache[category['attributes']['name'].lower()] = category['id']
+                
+                pagination = data.get('meta', {}).get('pagination', {})
+                if not data['data'] or pagination.get('current_page', 1) >= pagination.get('total_pages', 1):
+                    break
+                page += 1
+                params['page'] = page
+            except Exception as e:
+                print(f"Errore nel caricamento delle categorie: {str(e)}")
+                return
+        print(f"Caricate {len(self.categories_cache)} categorie da Firefly III")
+
+    def create_category(self, name):
+        """Crea una categoria in Firefly III e la aggiunge all'indice"""
+        key = name.lower()
+        if key in self.failed_categories:
             return None
-        if name in self.categories_cache:
-            return self.categories_cache[name]
         try:
-            response = requests.get(f"{self.host}/api/v1/categories", headers=self.headers)
-            response.raise_for_status()
-            categories = response.json()['data']
-            for category in categories:
-                if category['attributes']['name'].lower() == name.lower():
-                    category_id = category['id']
-                    self.categories_cache[name] = category_id
-                    return category_id
-            response = requests.post(
+            response = self.session.post(
                 f"{self.host}/api/v1/categories",
                 headers=self.headers,
                 json={"name": name}
             )
             if response.status_code == 422:
                 print(f"Attenzione: Impossibile creare la categoria '{name}'.")
+                self.failed_categories.add(key)
                 return None
             response.raise_for_status()
             category_id = response.json()['data']['id']
-            self.categories_cache[name] = category_id
+            self.categories_cache[key] = category_id
             return category_id
         except Exception as e:
             print(f"Errore con la categoria '{name}': {str(e)}")
+            self.failed_categories.add(key)
             return None
 
-    def import_transactions(self, transactions_data):
-        if not self.transactions_loaded:
-            print("Errore: Transazioni esistenti non caricate.")
-            return 0, 0, 0
+    def ensure_categories(self, names):
+        """Crea in blocco le categorie mancanti prima del ciclo di importazione"""
+        missing = {}
+        for name in names:
+            if not name or not name.strip():
+                continue
+            key = name.lower()
+            if key not in self.categories_cache and key not in self.failed_categories:
+                missing.setdefault(key, name)
+        for name in missing.values():
+            self.create_category(name)
+        if missing:
+            print(f"Create {len(missing)} nuove categorie in Firefly III")
+
+    def get_or_create_category(self, name):
+        if not name or name.strip() == "":
+            return None
+        category_id = self.categories_cache.get(name.lower())
+        if category_id is not None:
+            return category_id
+        return self.create_category(name)
+
+    def build_transaction(self, transaction):
+        """Prepara il payload Firefly per una transazione; restituisce None se va saltata"""
+        uuid = transaction.uuid
+        if not uuid:
+            print(f"Transazione senza UUID saltata: {transaction.description or 'N/A'}")
+            return None
+
+        # Usa solo UUID per il controllo dei duplicati
+        if uuid in self.duplicate_hashes:
+            return None
+
+        return {
+            "error_if_duplicate_hash": True,
+            "transactions": [self.transaction_split(transaction)]
+        }
+
+    def transaction_split(self, transaction):
+        """Dati Firefly di una transazione Tricount (usati sia per la creazione che per l'aggiornamento)"""
+        uuid = transaction.uuid
+        who_paid = transaction.who_paid
+        total_amount = abs(float(transaction.total or 0))
+        currency = transaction.currency or 'EUR'
+        description = (transaction.description or '').strip().lower()
+        transaction_date = transaction.date
+        category = transaction.category or ''
         
-        total_transactions = len(transactions_data)
-        imported_count = 0
-        skipped_count = 0
-        error_count = 0
+        category_id = self.get_or_create_category(category) if category else None
         
-        print(f"Inizio importazione di {total_transactions} transazioni...")
+        transaction_data = {
+            "type": "withdrawal",
+            "date": transaction_date,
+            "amount": str(total_amount),
+            "currency_code": currency,
+            "description": description,
+            "source_id": str(self.default_account_id),
+            "external_id": uuid,
+            "tags": ["imported", TRICOUNT_TAG]
+        }
         
-        for _, row in tqdm(transactions_data.iterrows(), total=total_transactions):
-            try:
-                uuid = row.get('UUID', '')
-                if not uuid:
-                    skipped_count += 1
-                    print(f"Transazione senza UUID saltata: {row.get('Description', 'N/A')}")
-                    continue
+        if category and category.strip():
+            transaction_data["category_name"] = category
+            
+        notes = f"Pagato da: {who_paid}"
+        involved = transaction.involved
+        if involved:
+            notes += f"\nCoinvolti: {involved}"
+        transaction_data["notes"] = notes
+        return transaction_data
 
-                who_paid = row.get('Who Paid', '')
-                total_amount = abs(float(row.get('Total', 0)))
-                currency = row.get('Currency', 'EUR')
-                description = row.get('Description', '') or ''
-                if pd.isna(description):
-                    description = "Transazione senza etichetta"
-                description = description.strip().lower()
-                
-                when = row.get('When', '')
-                if pd.isna(when):
-                    transaction_date = datetime.now().strftime('%Y-%m-%d')
-                else:
-                    transaction_date = pd.Timestamp(when).strftime('%Y-%m-%d')
-                
-                raw_category = row.get('RawCategory', '') or ''
-                category = row.get('Category', '') or ''
-                if pd.isna(raw_category):
-                    raw_category = ""
-                if pd.isna(category):
-                    category = ""
-                
-                # Usa solo UUID per il controllo dei duplicati
-                if uuid in self.duplicate_hashes:
-                    skipped_count += 1
-                    continue
-                
-                category_id = self.get_or_create_category(category) if category else None
-                
-                transaction_data = {
-                    "type": "withdrawal",
-                    "date": transaction_date,
-                    "amount": str(total_amount),
-                    "currency_code": currency,
-                    "description": description,
-                    "source_id": str(self.default_account_id),
-                    "external_id": uuid,
-                    "tags": ["imported", "tricount"]
-                }
-                
-                if category and category.strip():
-                    transaction_data["category_name"] = category
-                    
-                notes = f"Pagato da: {who_paid}"
-                involved = row.get('Involved', '')
-                if involved and not pd.isna(involved):
-                    notes += f"\nCoinvolti: {involved}"
-                transaction_data["notes"] = notes
-                
-                api_data = {
-                    "error_if_duplicate_hash": True,
-                    "transactions": [transaction_data]
-                }
+    def set_link(self, uuid, firefly_id, transaction=None, tricount_key=None, journal_id=None, split=False):
+        link = {
+            "id": str(firefly_id),
+            "journal": journal_id and str(journal_id),
+            "split": split,
+            "hash": transaction.content_hash() if transaction else None,
+            "tricount": tricount_key
+        }
+        with self.hashes_lock:
+            self.links[uuid] = link
+        self.hash_store.set_link(uuid, link)
+
+    def adopt_link(self, transaction, tricount_key=None, known_hash=None):
+        """Completa un collegamento trovato solo nella scansione Firefly (senza Tricount né impronta).
+
+        known_hash è l'impronta registrata all'ultima sincronizzazione (RegistryState): se la voce
+        è cambiata da allora l'aggiornamento viene inviato. Senza impronta registrata si usa il
+        contenuto attuale invece di inviare un aggiornamento, così le voci storiche (e le modifiche
+        fatte a mano in Firefly) non vengono riscritte.
+        """
+        link = self.links.get(transaction.uuid) if self.update_mode and transaction.uuid else None
+        if not link:
+            return
+        if tricount_key and not link.get("tricount"):
+            link["tricount"] = tricount_key
+        if link.get("hash") is None:
+            link["hash"] = known_hash or transaction.content_hash()
+
+    def adopt_links(self, transactions, tricount_key, known_entries=None):
+        """Collega al Tricount tutte le voci del registro scaricato, anche quelle non modificate"""
+        known_entries = known_entries or {}
+        for transaction in transactions:
+            self.adopt_link(transaction, tricount_key, known_entries.get(transaction.uuid))
+
+    def submit_transaction(self, api_data, transaction=None, tricount_key=None):
+        """Invia una transazione a Firefly III; restituisce 'imported', 'skipped' o 'error'"""
+        transaction_data = api_data["transactions"][0]
+        uuid = transaction_data["external_id"]
+        try:
+            response = self.session.post(
+                f"{self.host}/api/v1/transactions",
+                headers=self.headers,
+                json=api_data
+            )
+            
+            if response.status_code == 422:
+                error_message = response.json().get('message', 'Errore sconosciuto')
+                if "duplicate" in error_message.lower():
+                    with self.hashes_lock:
+                        self.duplicate_hashes[uuid] = transaction_data["date"]
+                    return "skipped"
+                print(f"Attenzione: Impossibile importare '{transaction_data['description']}': {error_message}")
+                self.failed_uuids.add(uuid)
+                return "error"
                 
-                response = requests.post(
-                    f"{self.host}/api/v1/transactions",
+            response.raise_for_status()
+            with self.hashes_lock:
+                self.duplicate_hashes[uuid] = transaction_data["date"]
+            self.hash_store.add(uuid, transaction_data["date"])
+            if self.update_mode:
+                group = response.json()['data']
+                journal_id = group['attributes']['transactions'][0].get('transaction_journal_id')
+                self.set_link(uuid, group['id'], transaction, tricount_key, journal_id)
+            return "imported"
+            
+        except Exception as e:
+            print(f"Errore: {str(e)}")
+            self.failed_uuids.add(uuid)
+            return "error"
+
+    def submit_batch(self, batch):
+        """Invia più transazioni come split di un unico gruppo Firefly; restituisce lo stato di ciascuna.
+
+        Se Firefly rifiuta il gruppo (validazione o duplicati, risposta 4xx) le transazioni
+        vengono reinviate una per una, così ogni UUID riceve il proprio esito. Dopo un timeout
+        o un errore 5xx il gruppo potrebbe essere stato creato comunque: le transazioni restano
+        in errore e alla prossima esecuzione Firefly segnala come duplicate quelle già presenti.
+        """
+        if len(batch) == 1:
+            return [self.submit_transaction(*batch[0])]
+        splits = [api_data["transactions"][0] for api_data, _, _ in batch]
+        api_data = {
+            "error_if_duplicate_hash": True,
+            "group_title": f"Tricount {splits[0]['date']}",
+            "transactions": splits
+        }
+        try:
+            response = self.session.post(
+                f"{self.host}/api/v1/transactions",
+                headers=self.headers,
+                json=api_data
+            )
+        except Exception as e:
+            print(f"Errore nell'invio di un gruppo di {len(batch)} transazioni: {str(e)}")
+            self.failed_uuids.update(split["external_id"] for split in splits)
+            return ["error"] * len(batch)
+        if 400 <= response.status_code < 500:
+            print(f"Gruppo di {len(batch)} transazioni rifiutato ({response.status_code}), invio singolo...")
+            return [self.submit_transaction(*item) for item in batch]
+        if response.status_code >= 300:
+            print(f"Errore nell'invio di un gruppo di {len(batch)} transazioni: HTTP {response.status_code}")
+            self.failed_uuids.update(split["external_id"] for split in splits)
+            return ["error"] * len(batch)
+        
+        with self.hashes_lock:
+            for split in splits:
+                self.duplicate_hashes[split["external_id"]] = split["date"]
+        for split in splits:
+            self.hash_store.add(split["external_id"], split["date"])
+        return ["imported"] * len(batch)
+
+    def batch_tasks(self, tasks):
+        """Raggruppa le nuove transazioni per data e valuta in richieste da batch_size split"""
+        if self.batch_size <= 1:
+            return tasks
+        other_tasks = []
+        groups = {}
+        for func, args in tasks:
+            if func != self.submit_transaction:
+                other_tasks.append((func, args))
+                continue
+            split = args[0]["transactions"][0]
+            groups.setdefault((split["date"], split["currency_code"]), []).append(args)
+        for items in groups.values():
+            for i in range(0, len(items), self.batch_size):
+                other_tasks.append((self.submit_batch, (items[i:i + self.batch_size],)))
+        return other_tasks
+
+    def resolve_link(self, uuid, link):
+        """Completa ID del journal e struttura del gruppo per i collegamenti salvati senza (versioni precedenti)"""
+        if link.get("journal"):
+            return link
+        response = self.session.get(f"{self.host}/api/v1/transactions/{link['id']}", headers=self.headers)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        splits = response.json()['data']['attributes']['transactions']
+        journal_id = next((split.get('transaction_journal_id') for split in splits if split.get('external_id') == uuid), None)
+        if journal_id is None:
+            return None
+        link = dict(link, journal=str(journal_id), split=len(splits) > 1)
+        with self.hashes_lock:
+            self.links[uuid] = link
+        self.hash_store.set_link(uuid, link)
+        return link
+
+    def delete_link(self, uuid, link):
+        """Elimina da Firefly III la voce collegata; in un gruppo con più split elimina solo il suo journal.
+
+        Restituisce False se la voce non esiste più in Firefly.
+        """
+        link = self.resolve_link(uuid, link)
+        if link is None:
+            return False
+        if link.get("split"):
+            # DELETE sul gruppo eliminerebbe anche le altre voci Tricount dello stesso gruppo
+            url = f"{self.host}/api/v1/transaction-journals/{link['journal']}"
+        else:
+            url = f"{self.host}/api/v1/transactions/{link['id']}"
+        response = self.session.delete(url, headers=self.headers)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        return True
+
+    def update_transaction(self, transaction, transaction_data, link, tricount_key=None):
+        """Aggiorna in Firefly III una transazione modificata su Tricount; restituisce 'updated', 'imported' o 'error'"""
+        uuid = transaction.uuid
+        api_data = {"error_if_duplicate_hash": True, "transactions": [transaction_data]}
+        try:
+            link = self.resolve_link(uuid, link)
+            if link and link.get("split"):
+                # Una PUT con un solo split riscriverebbe il gruppo eliminando gli altri:
+                # la voce viene tolta dal gruppo e reimportata come transazione a sé
+                self.delete_link(uuid, link)
+                self.forget(uuid)
+                status = self.submit_transaction(api_data, transaction, tricount_key)
+                return "updated" if status == "imported" else status
+            response = None
+            if link:
+                response = self.session.put(
+                    f"{self.host}/api/v1/transactions/{link['id']}",
                     headers=self.headers,
-                    json=api_data
+                    json={"apply_rules": False, "transactions": [transaction_data]}
                 )
-                
-                if response.status_code == 422:
-                    error_message = response.json().get('message', 'Errore sconosciuto')
-                    if "duplicate" in error_message.lower():
-                        skipped_count += 1
-                        self.duplicate_hashes[uuid] = transaction_date
-                    else:
-                        print(f"Attenzione: Impossibile importare '{description}': {error_message}")
-                        error_count += 1
-                    continue
-                    
-                response.raise_for_status()
-                self.duplicate_hashes[uuid] = transaction_date
-                imported_count += 1
-                
+            if response is None or response.status_code == 404:
+                # Eliminata a mano in Firefly: si dimentica il collegamento e la voce viene importata di nuovo
+                print(f"Transazione non trovata in Firefly III, nuova importazione di '{transaction_data['description']}'")
+                self.forget(uuid)
+                return self.submit_transaction(api_data, transaction, tricount_key)
+            if response.status_code == 422:
+                print(f"Attenzione: Impossibile aggiornare '{transaction_data['description']}': {response.text[:200]}")
+                self.failed_uuids.add(uuid)
+                return "error"
+            response.raise_for_status()
+            with self.hashes_lock:
+                self.duplicate_hashes[uuid] = transaction_data["date"]
+            self.hash_store.add(uuid, transaction_data["date"])
+            self.set_link(uuid, link["id"], transaction, tricount_key, link["journal"])
+            return "updated"
+        except Exception as e:
+            print(f"Errore nell'aggiornamento di {uuid}: {str(e)}")
+            self.failed_uuids.add(uuid)
+            return "error"
+
+    def forget(self, uuid):
+        """Rimuove UUID e collegamento di una voce che non esiste più in Firefly III"""
+        with self.hashes_lock:
+            self.links.pop(uuid, None)
+            self.duplicate_hashes.pop(uuid, None)
+        self.hash_store.remove_link(uuid)
+        self.hash_store.remove(uuid)
+
+    def delete_missing(self, tricount_key, current_uuids):
+        """Elimina da Firefly III le transazioni di un Tricount le cui voci non esistono più"""
+        if not self.update_mode or not current_uuids:
+            return 0
+        deleted = 0
+        forgotten = 0
+        for uuid_value, link in list(self.links.items()):
+            if link.get("tricount") != tricount_key or uuid_value in current_uuids:
+                continue
+            try:
+                removed = self.delete_link(uuid_value, link)
             except Exception as e:
-                print(f"Errore: {str(e)}")
-                error_count += 1
+                print(f"Errore nell'eliminazione della transazione {link['id']}: {str(e)}")
+                continue
+            # Già assente in Firefly (404): il collegamento va dimenticato ma non è un'eliminazione
+            self.forget(uuid_value)
+            forgotten += 1
+            if removed:
+                deleted += 1
+        if deleted:
+            print(f"Eliminate {deleted} transazioni non più presenti su Tricount")
+        if forgotten:
+            # delete_missing viene eseguito dopo l'ultimo salvataggio dell'importazione
+            self.save_hashes()
+        self.sync_stats["deleted"] += deleted
+        return deleted
+
+    def prepare_task(self, transaction, queued_uuids, tricount_key=None):
+        """Prepara la richiesta per una riga; restituisce (funzione, argomenti) oppure l'esito se non serve inviarla"""
+        uuid = transaction.uuid
+        if uuid and uuid in queued_uuids:
+            return "skipped"
+        try:
+            link = self.links.get(uuid) if self.update_mode and uuid in self.duplicate_hashes else None
+            if link:
+                self.adopt_link(transaction, tricount_key)
+                if link.get("hash") == transaction.content_hash():
+                    return "skipped"
+                # Voce già importata ma modificata su Tricount: aggiornamento mirato
+                transaction_data = self.transaction_split(transaction)
+                queued_uuids.add(uuid)
+                return self.update_transaction, (transaction, transaction_data, link, tricount_key)
+            api_data = self.build_transaction(transaction)
+        except Exception as e:
+            print(f"Errore: {str(e)}")
+            self.failed_uuids.add(uuid)
+            return "error"
+        if api_data is None:
+            return "skipped"
+        queued_uuids.add(uuid)
+        return self.submit_transaction, (api_data, transaction, tricount_key)
+
+    def task_chunks(self, transactions_data, count, tricount_key=None, chunk_size=IMPORT_CHUNK_SIZE):
+        """Prepara le righe in sequenza (cache categorie e UUID già visti) a blocchi di chunk_size richieste"""
+        queued_uuids = set()
+        chunk = []
+        for transaction in transactions_data:
+            task = self.prepare_task(transaction, queued_uuids, tricount_key)
+            if isinstance(task, str):
+                count(task)
+                continue
+            chunk.append(task)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def import_transactions(self, transactions_data, workers=None, tricount_key=None):
+        if not self.transactions_loaded:
+            print("Errore: Transazioni esistenti non caricate.")
+            return 0, 0, 0
+        
+        workers = workers or self.workers
+        counts = {"imported": 0, "skipped": 0, "error": 0, "updated": 0}
+        
+        # Con una lista le categorie mancanti vengono create in blocco; con un generatore
+        # (modalità streaming) vengono risolte riga per riga dall'indice precaricato
+        if isinstance(transactions_data, list):
+            print(f"Inizio importazione di {len(transactions_data)} transazioni...")
+            with METRICS.phase("category_resolution"):
+                self.ensure_categories({
+                    t.category for t in transactions_data
+                    if self.update_mode or t.uuid not in self.duplicate_hashes
+                })
+        else:
+            print("Inizio importazione delle transazioni in streaming...")
+        
+        with METRICS.phase("import"):
+            progress = tqdm(total=len(transactions_data) if isinstance(transactions_data, list) else None)
+            
+            def count(result):
+                # I gruppi restituiscono l'esito di ogni transazione, le richieste singole uno solo
+                statuses = result if isinstance(result, list) else [result]
+                for status in statuses:
+                    counts[status] += 1
+                progress.update(len(statuses))
+            
+            # In streaming le richieste partono a blocchi mentre le righe successive vengono ancora lette:
+            # l'importazione inizia subito e in memoria restano al massimo due blocchi.
+            # Una lista è già tutta in memoria: un solo blocco raggruppa meglio con --batch-size
+            chunk_size = max(1, len(transactions_data)) if isinstance(transactions_data, list) else IMPORT_CHUNK_SIZE
+            executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+            pending = []
+            try:
+                for chunk in self.task_chunks(transactions_data, count, tricount_key, chunk_size):
+                    tasks = self.batch_tasks(chunk)
+                    if executor is None:
+                        for func, args in tasks:
+                            count(func(*args))
+                        continue
+                    futures = [executor.submit(func, *args) for func, args in tasks]
+                    for future in pending:
+                        count(future.result())
+                    pending = futures
+                for future in pending:
+                    count(future.result())
+            finally:
+                if executor:
+                    executor.shutdown(wait=True)
+                progress.close()
         
-        self.save_hashes()
-        print(f"Importazione completata: {imported_count} importate, {skipped_count} saltate, {error_count} errori.")
+        imported_count, skipped_count, error_count = counts["imported"], counts["skipped"], counts["error"]
+        self.sync_stats["updated"] += counts["updated"]
+        with METRICS.phase("hash_save"):
+            self.save_hashes()
+        updated_message = f", {counts['updated']} aggiornate" if self.update_mode else ""
+        print(f"Importazione completata: {imported_count} importate{updated_message}, {skipped_count} saltate, {error_count} errori.")
         return imported_count, skipped_count, error_count
 
-def tricount_to_firefly(tricount_key=DEFAULT_TRICOUNT_KEY, firefly_host=DEFAULT_FIREFLY_HOST, firefly_token=DEFAULT_FIREFLY_TOKEN, save_excel=True, days_range=DEFAULT_DAYS_RANGE):
-    current_time = datetime.now().strftime("%Y/%m/%d %H:%M")
-    print(f"==============::::::: {current_time} :::::::==============")
-    
-    print("=== FASE 1: Connessione a Tricount ===")
-    api = TricountAPI()
-    print("Autenticazione con Tricount...")
-    api.authenticate()
+def load_tricount_keys(path):
+    """Legge le chiavi Tricount da file: lista JSON oppure una chiave per riga"""
+    with open(path, 'r') as f:
+        content = f.read()
+    if content.lstrip().startswith('['):
+        return [str(key).strip() for key in json.loads(content) if str(key).strip()]
+    return [line.strip() for line in content.splitlines() if line.strip() and not line.strip().startswith('#')]
+
+def fetch_tricount(api, tricount_key, raw_file, raw_dump=DEFAULT_RAW_DUMP):
+    """Scarica il registro di un Tricount e ne salva (opzionalmente) la risposta grezza"""
     print(f"Recupero dati per la chiave: {tricount_key}")
     data = api.fetch_tricount_data(tricount_key)
 
-    with open('response_data.json', 'w') as f:
-        json.dump(data, f, indent=2)
-    print("Dati grezzi salvati in response_data.json")
+    if raw_file:
+        indent = 2 if raw_dump == "pretty" else None
+        separators = None if indent else (',', ':')
+        with open_raw_dump(raw_file, raw_dump) as f:
+            f.write(json.dumps(data, indent=indent, separators=separators).encode())
+        print(f"Dati grezzi salvati in {raw_file}")
+    return data
 
+def prepare_tricount(data, exporter=None):
+    """Estrae le transazioni da un registro Tricount; restituisce (titolo, transazioni)"""
     handler = TricountHandler()
     tricount_title = handler.get_tricount_title(data)
     print(f"Elaborazione dati per: {tricount_title}")
-    transactions = handler.parse_tricount_data(data)
+    with METRICS.phase("parse"):
+        transactions = handler.parse_tricount_data(data)
     
-    file_name = f"Transactions {tricount_title}"
-    if save_excel:
-        df = handler.write_to_excel(transactions, file_name=file_name)
-    else:
-        df = pd.DataFrame(transactions)
+    if exporter:
+        exporter.submit(transactions, tricount_title)
     
     print(f"Estratte {len(transactions)} transazioni da Tricount")
+    return tricount_title, transactions
+
+def stream_tricount(api, importer, tricount_key, raw_file, raw_dump, exporter=None, registry_state=None):
+    """Scarica e importa un Tricount in streaming; restituisce (titolo, totale transazioni, risultato importazione)"""
+    print(f"Recupero dati in streaming per la chiave: {tricount_key}")
+    with METRICS.phase("fetch"):
+        # Fino agli header della risposta: il corpo viene letto durante il parsing
+        response = api.stream_tricount_data(tricount_key)
+    sink = open_raw_dump(raw_file, raw_dump)
+    registry_info = {}
+    # L'export riceve le righe mentre vengono lette, in parallelo all'importazione
+    export = exporter.open_stream(tricount_key) if exporter else None
+    completed = False
+    entries = {}
+    # Impronte dell'ultima sincronizzazione, per completare i collegamenti trovati solo in Firefly
+    known_entries = registry_state.known_entries(tricount_key) if registry_state else {}
+    total = 0
+    unchanged = 0
+    
+    def records():
+        nonlocal total, unchanged
+        parsed = TricountHandler.iter_tricount_data(TeeReader(response.raw, sink), registry_info)
+        # Il parsing (lettura del corpo inclusa) avviene dentro la fase di import:
+        # viene misurato a parte e registrato una sola volta, senza costi per riga
+        parse_seconds = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                transaction = next(parsed, None)
+                parse_seconds += time.perf_counter() - start
+                if transaction is None:
+                    break
+                total += 1
+                if export:
+                    export.put(transaction)
+                if transaction.uuid:
+                    entries[transaction.uuid] = transaction.content_hash()
+                    importer.adopt_link(transaction, tricount_key, known_entries.get(transaction.uuid))
+                # Le voci non modificate dall'ultima sincronizzazione non arrivano all'importatore
+                if registry_state and transaction.uuid and not registry_state.is_changed(tricount_key, transaction):
+                    unchanged += 1
+                    continue
+                yield transaction
+        finally:
+            METRICS.add_phase("parse", parse_seconds)
+    
+    try:
+        imported, skipped, errors = importer.import_transactions(records(), tricount_key=tricount_key)
+        result = (imported, skipped + unchanged, errors)
+        importer.delete_missing(tricount_key, set(entries))
+        if registry_state and importer.transactions_loaded:
+            registry_state.update(tricount_key, entries, importer.failed_uuids)
+        completed = True
+    finally:
+        if export:
+            export.close(registry_info.get("title", tricount_key) if completed else None)
+        response.close()
+        if sink:
+            sink.close()
+            print(f"Dati grezzi salvati in {raw_file}")
+    
+    tricount_title = registry_info.get("title", tricount_key)
+    print(f"Elaborati {total} movimenti per: {tricount_title}")
+    return tricount_title, total, result
+
+def tricount_to_firefly(tricount_key=DEFAULT_TRICOUNT_KEY, firefly_host=DEFAULT_FIREFLY_HOST, firefly_token=DEFAULT_FIREFLY_TOKEN, save_excel=True, days_range=DEFAULT_DAYS_RANGE, workers=DEFAULT_WORKERS, pool_size=DEFAULT_POOL_SIZE, full_scan=False, hash_backend=DEFAULT_HASH_BACKEND, stream=False, raw_dump=DEFAULT_RAW_DUMP, category_map=CATEGORY_MAP_FILE, report_file=RUN_REPORT_FILE, prometheus_file=None, detect_changes=True, update_mode=False, batch_size=DEFAULT_BATCH_SIZE, export_format=DEFAULT_EXPORT_FORMAT, warm_state=None):
+    """Importa uno o più Tricount in Firefly III; tricount_key può essere una chiave o una lista di chiavi.
+
+    warm_state è un dizionario riutilizzato tra esecuzioni successive (modalità --watch):
+    conserva sessione Tricount, importatore Firefly (cache categorie, UUID) e impronte dei registri.
+    """
+    METRICS.reset()
+    warm = warm_state if warm_state is not None else {}
+    tricount_keys = [tricount_key] if isinstance(tricount_key, str) else list(dict.fromkeys(tricount_key))
+    batch = len(tricount_keys) > 1
+    if stream and ijson is None:
+        print("Attenzione: modalità streaming non disponibile (pip install ijson), uso il caricamento completo.")
+        stream = False
+    if stream and raw_dump == "pretty":
+        # In streaming i byte vengono copiati così come arrivano: non è possibile reindentarli
+        raise ValueError("--raw-dump pretty non è supportato con --stream (usa json o gzip)")
+    current_time = datetime.now().strftime("%Y/%m/%d %H:%M")
+    print(f"==============::::::: {current_time} :::::::==============")
+    TricountHandler.load_category_map(category_map)
+    registry_state = warm.get("registry_state")
+    if registry_state is None:
+        registry_state = warm["registry_state"] = RegistryState(REGISTRY_STATE_FILE if detect_changes else None, firefly_host)
+        registry_state.load()
     
-    print("\n=== FASE 2: Importazione in Firefly III ===")
-    importer = FireflyIIIImporter(firefly_host, firefly_token, days_range)
-    imported, skipped, errors = importer.import_transactions(df)
+    print("=== FASE 1: Connessione a Tricount ===")
+    api = warm.get("api")
+    if api is None:
+        with METRICS.phase("authenticate"):
+            api = warm["api"] = TricountAPI()
+            print("Autenticazione con Tricount...")
+            api.authenticate()
     
-    importer.clean_duplicate_hashes()
+    def get_importer():
+        if "importer" in warm:
+            warm["importer"].start_run()
+        else:
+            warm["importer"] = FireflyIIIImporter(firefly_host, firefly_token, days_range, workers, pool_size, full_scan, create_hash_store(hash_backend), update_mode, batch_size)
+        return warm["importer"]
+    
+    # L'export viene scritto in background mentre si importa in Firefly III
+    exporter = BackgroundExporter(export_format) if save_excel else None
+    results = {}  # chiave -> (titolo, totale transazioni, (importate, saltate, errori))
+    importer = None
+    if stream:
+        # In streaming il registro viene letto mentre si importa: Firefly va preparato prima
+        print("\n=== FASE 2: Importazione in streaming in Firefly III ===")
+        importer = get_importer()
+        for key in tricount_keys:
+            try:
+                results[key] = stream_tricount(api, importer, key, raw_dump_path(key, raw_dump, batch), raw_dump, exporter, registry_state)
+            except Exception as e:
+                print(f"Errore nel recupero del Tricount {key}: {str(e)}")
+    else:
+        # Con più Tricount i registri vengono scaricati in parallelo con la stessa sessione
+        registries = {}
+        with METRICS.phase("fetch"), ThreadPoolExecutor(max_workers=max(1, min(len(tricount_keys), pool_size))) as executor:
+            futures = {
+                executor.submit(fetch_tricount, api, key, raw_dump_path(key, raw_dump, batch), raw_dump): key
+                for key in tricount_keys
+            }
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    registries[key] = future.result()
+                except Exception as e:
+                    print(f"Errore nel recupero del Tricount {key}: {str(e)}")
+        
+        prepared = {}
+        for key in tricount_keys:
+            if key in registries:
+                prepared[key] = prepare_tricount(registries.pop(key), exporter)
+        
+        # Solo le voci nuove o modificate arrivano a Firefly; se non ce ne sono Firefly non viene contattato
+        changed = {}
+        for key, (tricount_title, transactions) in prepared.items():
+            changed[key] = registry_state.changed_transactions(key, transactions)
+            # In modalità update anche le sole eliminazioni richiedono Firefly
+            if not changed[key] and not (update_mode and registry_state.removed_uuids(key, transactions)):
+                print(f"Nessuna modifica in '{tricount_title}' dall'ultima sincronizzazione")
+                results[key] = (tricount_title, len(transactions), (0, len(transactions), 0))
+        
+        pending_keys = [key for key in prepared if key not in results]
+        if pending_keys:
+            print("\n=== FASE 2: Importazione in Firefly III ===")
+            importer = get_importer()
+            for key in pending_keys:
+                tricount_title, transactions = prepared[key]
+                print(f"Importazione di: {tricount_title} ({len(changed[key])} voci nuove o modificate)")
+                importer.adopt_links(transactions, key, registry_state.known_entries(key))
+                imported, skipped, errors = importer.import_transactions(changed[key], tricount_key=key)
+                unchanged = len(transactions) - len(changed[key])
+                results[key] = (tricount_title, len(transactions), (imported, skipped + unchanged, errors))
+                importer.delete_missing(key, {t.uuid for t in transactions if t.uuid})
+                if importer.transactions_loaded:
+                    registry_state.update(key, {t.uuid: t.content_hash() for t in transactions if t.uuid}, importer.failed_uuids)
+        elif prepared:
+            print("\nNessuna modifica nei Tricount: importazione in Firefly III saltata")
+    
+    if importer:
+        with METRICS.phase("hash_save"):
+            importer.clean_duplicate_hashes()
+        if warm_state is None:
+            importer.hash_store.close()
+        registry_state.save()
+    if exporter:
+        with METRICS.phase("export_wait"):
+            exporter.close()
     
     print("\n=== RIEPILOGO ===")
-    print(f"Tricount: {tricount_title}")
-    print(f"Transazioni totali: {len(transactions)}")
-    print(f"Firefly III: {imported} importate, {skipped} saltate, {errors} errori")
+    for key in tricount_keys:
+        if key not in results:
+            print(f"Tricount: {key} - recupero non riuscito")
+            continue
+        tricount_title, total, (imported, skipped, errors) = results[key]
+        print(f"Tricount: {tricount_title}")
+        print(f"Transazioni totali: {total}")
+        print(f"Firefly III: {imported} importate, {skipped} saltate, {errors} errori")
+    imported, skipped, errors = (sum(result[2][i] for result in results.values()) for i in range(3))
+    if batch:
+        print(f"Totale {len(results)}/{len(tricount_keys)} Tricount: {imported} importate, {skipped} saltate, {errors} errori")
+    if update_mode and importer:
+        print(f"Modalità update: {importer.sync_stats['updated']} aggiornate, {importer.sync_stats['deleted']} eliminate")
+    sessions = [("Tricount", api.session)] + ([("Firefly III", importer.session)] if importer else [])
+    connections = {}
+    for name, session in sessions:
+        requests_count, connections_count, reused_count = session_stats(session)
+        connections[name] = {"requests": requests_count, "opened": connections_count, "reused": reused_count}
+        print(f"Connessioni {name}: {requests_count} richieste, {connections_count} aperte, {reused_count} riutilizzate")
+    
+    totals = {"imported": imported, "skipped": skipped, "errors": errors}
+    if importer:
+        totals.update(importer.sync_stats)
+    try:
+        if report_file:
+            tricounts = {
+                key: {"title": title, "transactions": total, "imported": result[0], "skipped": result[1], "errors": result[2]}
+                for key, (title, total, result) in results.items()
+            }
+            METRICS.write_json(report_file, tricounts=tricounts, totals=totals, connections=connections)
+        if prometheus_file:
+            METRICS.write_prometheus(prometheus_file, totals)
+    except Exception as e:
+        print(f"Errore nella scrittura del report: {str(e)}")
     print("=============================================================")
     print("\n\n")
     
     return imported, skipped, errors
 
+class RunLock:
+    """Impedisce che due esecuzioni (es. cron sovrapposti) importino in parallelo nello stesso Firefly"""
+    def __init__(self, path=LOCK_FILE):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        """Restituisce False se un'altra esecuzione detiene già il lock"""
+        if fcntl:
+            # flock viene rilasciato dal kernel anche se il processo termina in modo anomalo
+            self.file = open(self.path, 'a+')
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.file.close()
+                self.file = None
+                return False
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write(str(os.getpid()))
+            self.file.flush()
+            return True
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        self.file = os.fdopen(fd, 'w')
+        self.file.write(str(os.getpid()))
+        self.file.flush()
+        return True
+
+    def release(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if not fcntl:
+            os.remove(self.path)
+
+def watch(tricount_keys, interval=DEFAULT_WATCH_INTERVAL, jitter=DEFAULT_WATCH_JITTER, **options):
+    """Esegue la sincronizzazione a intervalli regolari restando in memoria, fino a SIGTERM/SIGINT"""
+    stop = threading.Event()
+    
+    def request_stop(signum, frame):
+        print(f"Ricevuto segnale {signum}: arresto al termine della sincronizzazione in corso...")
+        stop.set()
+    
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    
+    warm_state = {}
+    failures = 0
+    print(f"Modalità watch: sincronizzazione ogni {interval} secondi (Ctrl+C o SIGTERM per terminare)")
+    while not stop.is_set():
+        try:
+            tricount_to_firefly(tricount_key=tricount_keys, warm_state=warm_state, **options)
+            failures = 0
+        except (Exception, SystemExit) as e:
+            # FireflyIIIImporter chiama exit() se Firefly non è raggiungibile: in watch si riprova più tardi
+            failures += 1
+            print(f"Errore nella sincronizzazione ({failures} consecutivi): {str(e) or type(e).__name__}")
+            if "importer" in warm_state and not warm_state["importer"].transactions_loaded:
+                warm_state.pop("importer").hash_store.close()
+        delay = min(interval * (2 ** failures), WATCH_MAX_BACKOFF) if failures else interval
+        delay += random.uniform(0, delay * jitter)
+        if not stop.is_set():
+            print(f"Prossima sincronizzazione tra {delay:.0f} secondi")
+        stop.wait(delay)
+    
+    if "importer" in warm_state:
+        warm_state["importer"].hash_store.close()
+    print("Modalità watch terminata")
+
 def main():
     parser = argparse.ArgumentParser(description='Importa dati da Tricount a Firefly III')
-    parser.add_argument('--tricount-key', default=DEFAULT_TRICOUNT_KEY, help='Chiave Tricount')
+    parser.add_argument('--tricount-key', nargs='+', default=[DEFAULT_TRICOUNT_KEY], help='Chiave Tricount (anche più di una)')
+    parser.add_argument('--tricount-config', help='File con le chiavi Tricount da sincronizzare (lista JSON o una chiave per riga)')
     parser.add_argument('--firefly-host', default=DEFAULT_FIREFLY_HOST, help='URL Firefly III')
     parser.add_argument('--firefly-token', default=DEFAULT_FIREFLY_TOKEN, help='Token Firefly III')
     parser.add_argument('--days-range', type=int, default=DEFAULT_DAYS_RANGE, help='Numero di giorni per il range temporale di caricamento e conservazione hash')
-    parser.add_argument('--no-excel', action='store_true', help='Non salvare Excel')
+    parser.add_argument('--no-excel', action='store_true', help='Non salvare l\'export delle transazioni')
+    parser.add_argument('--export-format', choices=sorted(EXPORT_FORMATS), default=DEFAULT_EXPORT_FORMAT, help='Formato dell\'export delle transazioni')
+    parser.add_argument('--stream', action='store_true', help='Legge il registro Tricount in streaming e lo importa una transazione alla volta (richiede ijson)')
+    parser.add_argument('--raw-dump', choices=['none', 'json', 'pretty', 'gzip'], default=DEFAULT_RAW_DUMP, help='Formato del dump della risposta grezza di Tricount')
+    parser.add_argument('--category-map', default=CATEGORY_MAP_FILE, help='File JSON con la mappatura categorie Tricount -> Firefly')
+    parser.add_argument('--report-file', default=RUN_REPORT_FILE, help='File JSON con durate delle fasi e statistiche HTTP (vuoto per disattivarlo)')
+    parser.add_argument('--prometheus-file', help='File .prom per il textfile collector di Prometheus')
+    parser.add_argument('--no-change-detection', action='store_true', help='Importa sempre tutte le voci, anche se il registro Tricount non è cambiato')
+    parser.add_argument('--update', action='store_true', help='Aggiorna in Firefly le voci modificate su Tricount ed elimina quelle cancellate')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Numero di transazioni inviate in un unico gruppo Firefly (ignorato con --update)')
+    parser.add_argument('--watch', action='store_true', help='Resta in esecuzione e sincronizza a intervalli regolari invece di uscire')
+    parser.add_argument('--interval', type=int, default=DEFAULT_WATCH_INTERVAL, help='Secondi tra due sincronizzazioni in modalità --watch')
+    parser.add_argument('--jitter', type=float, default=DEFAULT_WATCH_JITTER, help='Variazione casuale dell\'intervallo, come frazione (0.1 = fino al 10%%)')
+    parser.add_argument('--lock-file', default=LOCK_FILE, help='File di lock che impedisce esecuzioni sovrapposte')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Numero di richieste parallele verso Firefly III')
+    parser.add_argument('--full-scan', action='store_true', help='Forza la scansione completa delle transazioni Firefly esistenti')
+    parser.add_argument('--hash-backend', choices=sorted(HASH_STORES), default=DEFAULT_HASH_BACKEND, help='Backend per salvare gli UUID importati')
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE, help='Numero di connessioni HTTP persistenti verso Firefly III')
     
     args = parser.parse_args()
+    if args.stream and args.raw_dump == "pretty":
+        parser.error("--raw-dump pretty non è supportato con --stream (usa json o gzip)")
     
-    tricount_to_firefly(
-        tricount_key=args.tricount_key,
+    tricount_keys = load_tricount_keys(args.tricount_config) if args.tricount_config else args.tricount_key
+    
+    options = dict(
         firefly_host=args.firefly_host,
         firefly_token=args.firefly_token,
         save_excel=not args.no_excel,
-        days_range=args.days_range
+        export_format=args.export_format,
+        days_range=args.days_range,
+        workers=args.workers,
+        pool_size=args.pool_size,
+        full_scan=args.full_scan,
+        hash_backend=args.hash_backend,
+        stream=args.stream,
+        raw_dump=args.raw_dump,
+        category_map=args.category_map,
+        report_file=args.report_file,
+        prometheus_file=args.prometheus_file,
+        detect_changes=not args.no_change_detection,
+        update_mode=args.update,
+        batch_size=args.batch_size
     )
+    
+    run_lock = RunLock(args.lock_file)
+    if not run_lock.acquire():
+        print(f"Un'altra esecuzione è già in corso (lock {args.lock_file}): esco")
+        exit(1)
+    try:
+        if args.watch:
+            watch(tricount_keys, interval=args.interval, jitter=args.jitter, **options)
+        else:
+            tricount_to_firefly(tricount_key=tricount_keys, **options)
+    finally:
+        run_lock.release()
 
 if __name__ == "__main__":
     main()